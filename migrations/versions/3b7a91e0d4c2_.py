@@ -0,0 +1,35 @@
+"""Keep a per-guild emote counter and make shared links unique.
+
+The counter backs the 10 emote quota so it can be checked under a row lock
+instead of counting the guild's emotes. Duplicate shared links are removed
+before the unique constraint is added.
+
+Revision ID: 3b7a91e0d4c2
+Revises: 9e4d2f61c8b0
+Create Date: 2026-10-18 19:21:07.615020
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3b7a91e0d4c2'
+down_revision = '9e4d2f61c8b0'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('guild', sa.Column('emote_count', sa.Integer(), server_default='0', nullable=False))
+
+    op.execute('DELETE FROM shared_emotes_link a USING shared_emotes_link b '
+               'WHERE a.ctid < b.ctid AND a.guild_id = b.guild_id AND a.emote_id = b.emote_id')
+    op.create_unique_constraint('uq_shared_emotes_link', 'shared_emotes_link', ['guild_id', 'emote_id'])
+
+    op.execute('UPDATE guild SET emote_count = '
+               '(SELECT count(*) FROM emote WHERE emote.owner_id = guild.id) + '
+               '(SELECT count(*) FROM shared_emotes_link WHERE shared_emotes_link.guild_id = guild.id)')
+
+
+def downgrade():
+    op.drop_constraint('uq_shared_emotes_link', 'shared_emotes_link', type_='unique')
+    op.drop_column('guild', 'emote_count')
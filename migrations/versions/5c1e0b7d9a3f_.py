@@ -0,0 +1,26 @@
+"""Index emote filenames for the shared, content-addressed blob store.
+
+Emote files are now stored once per hash and shared between guilds. The
+filename index is used to count the references to a blob. Existing files
+are moved into the blob store with ``flask emotes migrate-blobs``.
+
+Revision ID: 5c1e0b7d9a3f
+Revises: a7f3bef62fdb
+Create Date: 2026-10-18 18:02:11.482913
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5c1e0b7d9a3f'
+down_revision = 'a7f3bef62fdb'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index(op.f('ix_emote_filename'), 'emote', ['filename'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_emote_filename'), table_name='emote')
@@ -0,0 +1,23 @@
+"""Add a partial index for keyset pagination of the shared library.
+
+Revision ID: 9e4d2f61c8b0
+Revises: 5c1e0b7d9a3f
+Create Date: 2026-10-18 18:40:52.107364
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9e4d2f61c8b0'
+down_revision = '5c1e0b7d9a3f'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('ix_emote_library', 'emote', ['id'], unique=False,
+                    postgresql_where=sa.text('shared = true AND verified = true'))
+
+
+def downgrade():
+    op.drop_index('ix_emote_library', table_name='emote')
@@ -0,0 +1,23 @@
+"""Add a partial index for the moderation queue of unverified emotes.
+
+Revision ID: c4f8e2a7b619
+Revises: 3b7a91e0d4c2
+Create Date: 2026-10-18 20:12:43.903516
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c4f8e2a7b619'
+down_revision = '3b7a91e0d4c2'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('ix_emote_unverified', 'emote', ['id'], unique=False,
+                    postgresql_where=sa.text('verified = false OR verified IS NULL'))
+
+
+def downgrade():
+    op.drop_index('ix_emote_unverified', table_name='emote')
@@ -0,0 +1,23 @@
+"""Add a trigram index on emote names for library search.
+
+Revision ID: e61d0b3f52a8
+Revises: c4f8e2a7b619
+Create Date: 2026-10-18 20:48:19.226714
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e61d0b3f52a8'
+down_revision = 'c4f8e2a7b619'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.execute('CREATE INDEX ix_emote_name_trgm ON emote USING gin (name gin_trgm_ops)')
+
+
+def downgrade():
+    op.execute('DROP INDEX ix_emote_name_trgm')
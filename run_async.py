@@ -0,0 +1,29 @@
+"""Serves the application with cooperative (gevent) workers.
+
+Most request time is spent waiting on Redis, PostgreSQL and Discord. Patching
+the standard library makes all of that I/O cooperative, so one worker process
+can serve many requests concurrently with the same synchronous views:
+
+    $ gunicorn -k gevent --worker-connections 1000 run_async:app
+
+Requires ``gevent`` and ``psycogreen`` (``pip install -r requirements-async.txt``).
+
+Process pools don't mix with a monkey-patched standard library, so images are
+validated and resized inline in this mode (``DERIVATIVE_WORKERS = 0``); they
+are at most 128x128 and take milliseconds. The cache invalidation listener
+runs as a greenlet like everything else and needs no special handling.
+"""
+from gevent import monkey
+monkey.patch_all()
+
+from psycogreen.gevent import patch_psycopg
+patch_psycopg()
+
+from website import create_app
+
+app = create_app('config')
+app.config['DERIVATIVE_WORKERS'] = 0
+
+if __name__ == '__main__':
+    from gevent.pywsgi import WSGIServer
+    WSGIServer(('127.0.0.1', 5000), app).serve_forever()
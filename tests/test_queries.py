@@ -0,0 +1,50 @@
+"""
+Pins the number of SQL statements the hot paths run.
+
+Runs against SQLite and fakeredis, no services needed.
+"""
+import tempfile
+import types
+
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+
+from website import create_app
+from website.models import Emote, Guild, add_shared_emote, db, guild_emotes
+from website.testing import assert_num_queries
+
+
+@pytest.fixture(scope='module')
+def app():
+    conf = types.SimpleNamespace(
+        OAUTH2_CLIENT_ID='id', OAUTH2_SECRET_KEY='secret', OAUTH2_REDIRECT_URI='http://localhost/callback',
+        UPLOAD_FOLDER=tempfile.mkdtemp(), SQLALCHEMY_DATABASE_URI='sqlite://', EMOTES_PER_PAGE=20,
+        SECRET_KEY='secret', REDIS_CONN=('127.0.0.1', 6379), DERIVATIVE_WORKERS=0,
+    )
+    app = create_app(conf)
+    app.redis = fakeredis.FakeStrictRedis()
+    with app.app_context():
+        db.create_all()
+        db.session.add_all([Guild(id=1, name='owner'), Guild(id=2, name='other')])
+        db.session.add_all([Emote(owner_id=1, name='emote%d' % i, filename='%d.png' % i, shared=True, verified=True)
+                            for i in range(5)])
+        db.session.commit()
+        yield app
+
+
+def test_guild_emotes(app):
+    # owned and shared emotes come back in one query, however many there are
+    with assert_num_queries(1):
+        assert len(guild_emotes(1)) == 5
+
+
+def test_add_shared_emote(app):
+    emote = Emote.query.filter_by(name='emote0').one()
+
+    # quota lock, link insert, count update
+    with assert_num_queries(3):
+        add_shared_emote(2, emote)
+
+    assert [e.name for e in guild_emotes(2)] == ['emote0']
+    assert db.session.query(Guild.emote_count).filter_by(id=2).scalar() == 1
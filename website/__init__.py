@@ -1,21 +1,25 @@
-from flask import Flask, g
+from flask import Flask
 
 import os
 
-from . import views, models, admin_views, discord
-
-def before_request():
-    g.user = discord.User.current()
-    g.guilds = discord.BriefGuild.managed()
+from . import views, models, admin_views, commands, derivatives, sessions
+from .utils import RequestGlobals
 
 def create_app(conf):
     app = Flask(__name__)
+    # g.user and g.guilds are resolved lazily, at most once per request
+    app.app_ctx_globals_class = RequestGlobals
     app.config.update(
         MAX_CONTENT_LENGTH=2*1024*1024, # 2 MiB max upload
+        EMOTE_MAX_BYTES=256*1024, # 128x128 images never need more than this
         SQLALCHEMY_TRACK_MODIFICATIONS=False
     )
     app.config.from_object(conf)
 
+    if app.config.get('SERVER_SIDE_SESSION'):
+        # keep the session, OAuth2 token included, in redis and only its ID in the cookie
+        app.session_interface = sessions.RedisSessionInterface()
+
     app.config['UPLOAD_FOLDER'] = os.path.realpath(app.config['UPLOAD_FOLDER'])
 
     try:
@@ -26,8 +30,6 @@ def create_app(conf):
     if 'http://' in app.config['OAUTH2_REDIRECT_URI']:
         os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = 'true'
 
-    app.before_request(before_request)
-
     # extension lazy init
     admin_views.admin.init_app(app)
     models.db.init_app(app)
@@ -35,4 +37,10 @@ def create_app(conf):
     views.csrf.init_app(app)
 
     app.register_blueprint(views.main)
+    app.add_template_global(derivatives.emote_url)
+
+    app.cli.add_command(commands.outbox_command)
+    app.cli.add_command(commands.reaper_command)
+    app.cli.add_command(commands.tokens_command)
+    app.cli.add_command(commands.emotes)
     return app
@@ -1,17 +1,16 @@
 from flask_admin.contrib.sqla import ModelView
 from flask_admin.actions import action
-from flask_admin import Admin, AdminIndexView, expose
-from flask import flash, current_app, url_for
+from flask_admin import Admin, AdminIndexView, BaseView, expose
+from flask import flash, g, request, redirect, url_for, current_app
 from jinja2 import Markup
 from gettext import ngettext
 
-from .models import Emote, Guild, db
-from .discord import User
+from .models import Emote, Guild, db, bulk_set_verified, bulk_unshare, bulk_delete
+from .derivatives import emote_url
 
 class CustomAdminIndexView(AdminIndexView):
     def is_accessible(self):
-        user = User.current()
-        return user and user.id in current_app.config['ADMIN_USER_IDS']
+        return g.is_admin
 
 admin = Admin(name='Discord Emotes', template_mode='bootstrap3', index_view=CustomAdminIndexView())
 
@@ -28,36 +27,86 @@ class EmoteView(ModelView):
         'filename': 'Emote'
     }
 
-    @action('verify', 'Verify', 'Are you sure you want to verify the selected emotes?')
-    def action_verify(self, ids):
-        try:
-            new_ids = [int(i) for i in ids]
+    list_template = 'admin/emote_list.html'
 
-            # .update() sucks
-            emotes = Emote.query.filter(Emote.id.in_(new_ids)).all()
-            for emote in emotes:
-                emote.verified = True
+    # name -> (past tense, bulk function taking a criterion)
+    bulk_actions = {
+        'verify': ('verified', lambda criterion: bulk_set_verified(criterion, True)),
+        'unverify': ('unverified', lambda criterion: bulk_set_verified(criterion, False)),
+        'unshare': ('made private', bulk_unshare),
+        'delete': ('deleted', bulk_delete),
+    }
 
+    def run_bulk_action(self, name, criterion):
+        past_tense, func = self.bulk_actions[name]
+        try:
+            count = func(criterion)
             db.session.commit()
-
-            flash(ngettext('Emote successfully verified.',
-                           '%s emotes were successfully verified.' % len(emotes),
-                           emotes))
+            flash(ngettext('Emote successfully %s.' % past_tense,
+                           '%s emotes were successfully %s.' % (count, past_tense),
+                           count))
         except Exception as e:
+            db.session.rollback()
             if not self.handle_view_exception(e):
                 raise
 
-            flash('Failed to verify emotes. %s' % str(e), 'error')
+            flash('Failed to update emotes. %s' % str(e), 'error')
+
+    def _selected(self, ids):
+        return Emote.id.in_([int(i) for i in ids])
+
+    @action('verify', 'Verify', 'Are you sure you want to verify the selected emotes?')
+    def action_verify(self, ids):
+        self.run_bulk_action('verify', self._selected(ids))
+
+    @action('unverify', 'Unverify', 'Are you sure you want to unverify the selected emotes?')
+    def action_unverify(self, ids):
+        self.run_bulk_action('unverify', self._selected(ids))
+
+    @action('unshare', 'Unshare', 'Are you sure you want to make the selected emotes private?')
+    def action_unshare(self, ids):
+        self.run_bulk_action('unshare', self._selected(ids))
+
+    @action('delete', 'Delete', 'Are you sure you want to delete the selected emotes?')
+    def action_delete(self, ids):
+        self.run_bulk_action('delete', self._selected(ids))
+
+    def _matching_criterion(self):
+        """Builds a criterion matching every emote the list's active filters and search match.
+
+        Returns ``None`` when there is neither, a bulk action never runs over every emote.
+        """
+        view_args = self._get_list_extra_args()
+        if not view_args.search and not view_args.filters:
+            return None
+
+        _, query = self.get_list(0, None, False, view_args.search, view_args.filters, execute=False)
+        # drop the list's paging and ordering, only the conditions matter
+        ids = query.limit(None).offset(None).order_by(None).with_entities(Emote.id)
+        return Emote.id.in_(ids.subquery())
+
+    @expose('/bulk/', methods=['POST'])
+    def bulk_view(self):
+        """Applies an action to every emote matching the list's filters, not just a page of them.
+
+        The filters and search come in the query string, as on the list page.
+        """
+        action_name = request.form.get('action')
+        if action_name in self.bulk_actions:
+            criterion = self._matching_criterion()
+            if criterion is None:
+                flash('Filter or search the list first, bulk actions never apply to every emote.', 'error')
+            else:
+                self.run_bulk_action(action_name, criterion)
+        return redirect(url_for('.index_view', **request.args))
 
     def is_accessible(self):
-        user = User.current()
-        return user and user.id in current_app.config['ADMIN_USER_IDS']
+        return g.is_admin
 
     def _filename_formatter(view, context, model, name):
         if not model.filename:
             return ''
-        return Markup('<img style="width:32px;height:32px" src="%s">' % url_for('main.static_emote', guild_id=model.owner_id,
-                                                                                filename=model.filename))
+        return Markup('<img style="width:32px;height:32px" src="%s">' % emote_url(model, 32))
 
     column_formatters = {
         'filename': _filename_formatter,
@@ -65,6 +114,35 @@ class EmoteView(ModelView):
         'verified': _bool_formatter
     }
 
+class ModerationView(BaseView):
+    """A queue of unverified emotes, oldest first, reviewed a batch at a time."""
+
+    @expose('/')
+    def index(self):
+        after = request.args.get('after', type=int)
+        emotes = Emote.moderation_queue(current_app.config.get('MODERATION_BATCH_SIZE', 60), after=after)
+        return self.render('admin/moderation.html', emotes=emotes, pending=Emote.pending_review().count())
+
+    @expose('/decide', methods=['POST'])
+    def decide(self):
+        approved = [int(i) for i in request.form.getlist('approve')]
+        rejected = [int(i) for i in request.form.getlist('reject')]
+
+        try:
+            verified = bulk_set_verified(Emote.id.in_(approved), True) if approved else 0
+            deleted = bulk_delete(Emote.id.in_(rejected)) if rejected else 0
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        flash('%s emotes approved, %s rejected.' % (verified, deleted))
+        # decided emotes leave the queue, skipped ones stay before the cursor
+        return redirect(url_for('.index', after=request.form.get('after', type=int)))
+
+    def is_accessible(self):
+        return g.is_admin
+
 class GuildView(ModelView):
     column_formatters = {
         'public': _bool_formatter
@@ -72,3 +150,4 @@ class GuildView(ModelView):
 
 admin.add_view(EmoteView(Emote, db.session))
 admin.add_view(GuildView(Guild, db.session))
+admin.add_view(ModerationView(name='Moderation', endpoint='moderation'))
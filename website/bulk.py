@@ -0,0 +1,166 @@
+"""
+Bulk import and export of a guild's emotes.
+
+Imports read a ZIP archive or a directory of images named after the emotes
+they become (``pepe_hands.png``). Images are validated in parallel in a process
+pool, the emotes are inserted in a single transaction and only then are the
+files written to the blob store. Exports stream a ZIP archive of the guild's
+emotes without building it in memory.
+"""
+import io
+import os
+import re
+import zipfile
+
+from sqlalchemy.exc import IntegrityError
+
+from .forms import EMOTE_NAME_PATTERN
+from .models import Emote, Guild, db, guild_emotes, guild_emotes_query, MAX_GUILD_EMOTES
+from . import derivatives, images, storage
+
+# archives are read fully before validation, cap how much that can be
+MAX_ENTRIES = 100
+
+
+def read_entries(source, limit):
+    """Yields ``(emote name, data)`` for every file of a ZIP archive or directory.
+
+    ``source`` is a directory path, a ZIP path or a file object of a ZIP archive.
+    Files bigger than ``limit`` are yielded with ``None`` as their data.
+    Raises :exc:`RuntimeError` if the archive is unreadable or holds more than
+    :data:`MAX_ENTRIES` files.
+    """
+    if isinstance(source, str) and os.path.isdir(source):
+        names = [name for name in sorted(os.listdir(source)) if os.path.isfile(os.path.join(source, name))]
+        if len(names) > MAX_ENTRIES:
+            raise RuntimeError('Too many files (expected %s or less).' % MAX_ENTRIES)
+        for name in names:
+            path = os.path.join(source, name)
+            if os.path.getsize(path) > limit:
+                yield name, None
+                continue
+            with open(path, 'rb') as fp:
+                yield name, fp.read()
+        return
+
+    try:
+        archive = zipfile.ZipFile(source)
+    except (zipfile.BadZipFile, OSError):
+        raise RuntimeError('Invalid archive.')
+
+    with archive:
+        infos = [info for info in archive.infolist()
+                 if not info.filename.endswith('/') and not info.filename.startswith('__MACOSX/')]
+        if len(infos) > MAX_ENTRIES:
+            raise RuntimeError('Too many files (expected %s or less).' % MAX_ENTRIES)
+        for info in infos:
+            name = os.path.basename(info.filename)
+            if info.file_size > limit:
+                yield name, None
+                continue
+            yield name, archive.read(info)
+
+
+def _validate(data, limit):
+    # runs in a pool process
+    try:
+        return images.validate(io.BytesIO(data), limit), None
+    except RuntimeError as e:
+        return None, str(e)
+
+
+def import_emotes(guild_id, source, limit, executor, shared=True):
+    """Imports emotes into a guild.
+
+    Returns a ``(imported, errors)`` tuple where ``imported`` is the list of
+    new emote names and ``errors`` maps file names to why they were skipped.
+    """
+    errors = {}
+    candidates = []
+    for filename, data in read_entries(source, limit):
+        name = os.path.splitext(filename)[0]
+        if data is None:
+            errors[filename] = 'File too large (expected %s KiB or less)' % (limit // 1024)
+        elif not re.match(EMOTE_NAME_PATTERN, name) or '__' in name:
+            errors[filename] = 'Invalid emote name.'
+        else:
+            candidates.append((filename, name, data))
+
+    validated = executor.map(_validate, [data for _, _, data in candidates], [limit] * len(candidates))
+
+    # lock the guild's quota for the whole import
+    count = db.session.query(Guild.emote_count).filter(Guild.id == guild_id).with_for_update().scalar()
+    if count is None:
+        db.session.rollback()
+        raise RuntimeError('Unknown guild.')
+
+    names = [name for _, name, _ in candidates]
+    taken = {n for n, in db.session.query(Emote.name).filter(Emote.name.in_(names))} if names else set()
+    used = {f for f, in guild_emotes_query(guild_id).with_entities(Emote.filename)}
+
+    available = MAX_GUILD_EMOTES - count
+    emotes, blobs = [], {}
+    for (filename, name, _), (image, error) in zip(candidates, validated):
+        if error is not None:
+            errors[filename] = error
+        elif name in taken:
+            errors[filename] = 'An emote already exists with this name.'
+        elif image.filename in used:
+            errors[filename] = 'That image is already used for an emote.'
+        elif len(emotes) >= available:
+            errors[filename] = 'The guild has reached the maximum number of emotes.'
+        else:
+            taken.add(name)
+            used.add(image.filename)
+            blobs[image.filename] = image
+            emotes.append(Emote(name=name, owner_id=guild_id, shared=shared, filename=image.filename))
+
+    db.session.add_all(emotes)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # a name got taken since we checked
+        db.session.rollback()
+        raise RuntimeError('Some emote names were taken during the import, try again.')
+
+    imported = [emote.name for emote in emotes]
+    for filename, image in blobs.items():
+        if storage.save_blob(filename, image.data):
+            derivatives.schedule(filename, image.data)
+
+    return imported, errors
+
+
+class _ChunkStream(io.RawIOBase):
+    """A write-only stream that hands out what was written since the last call."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def export_emotes(guild_id):
+    """Yields a ZIP archive of a guild's emotes chunk by chunk."""
+    emotes = [(e.name, e.filename) for e in guild_emotes(guild_id)]
+    stream = _ChunkStream()
+    # images are already compressed
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_STORED) as archive:
+        for name, filename in emotes:
+            try:
+                data = storage.read_blob(filename)
+            except OSError:
+                continue
+            archive.writestr(name + os.path.splitext(filename)[1], data)
+            yield stream.pop()
+    yield stream.pop()
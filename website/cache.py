@@ -1,48 +1,335 @@
 """
 Caching utilities
+
+There are two tiers: a small in-process LRU cache that holds decoded values
+for a few seconds and Redis behind it. Workers keep their local tier coherent
+by publishing invalidated keys on ``CACHE_INVALIDATION_CHANNEL``.
+
+Rendered page fragments are cached per scope (``library``, ``guild:<id>``,
+``emote:<id>``...). Every scope has a generation counter that is bumped when
+its data changes, which retires all fragments rendered from the old data.
+
+Discord payloads are stored compactly: only the fields that
+:class:`~website.discord.User` and :class:`~website.discord.BriefGuild` read
+are kept, as positional rows, encoded with ``CACHE_SERIALIZER`` (``json`` or
+``msgpack``). Keys use the server-side session ID when there is one, or a short
+digest of the access token rather than the whole token dict.
 """
+import hashlib
 import json
+import threading
+import time
+from collections import OrderedDict
 
+import redis
 from flask import current_app
+from jinja2 import Markup
+
+
+class LocalCache:
+    """A thread-safe, size-bounded LRU cache with per-entry expiry."""
+
+    def __init__(self, maxsize=1024, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+USER_FIELDS = ('id', 'username', 'discriminator', 'avatar', 'email', 'verified', 'mfa_enabled')
+GUILD_FIELDS = ('id', 'name', 'icon', 'owner', 'permissions')
+
+
+def _pack(fields, data):
+    return [data.get(field) for field in fields]
+
+
+def _unpack(fields, row):
+    return dict(zip(fields, row))
+
+
+class JSONSerializer:
+    def dumps(self, value):
+        return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, raw):
+        return json.loads(raw.decode('utf-8'))
+
 
-from werkzeug.contrib.cache import RedisCache
+class MsgpackSerializer:
+    def __init__(self):
+        import msgpack
+        self.msgpack = msgpack
+
+    def dumps(self, value):
+        return self.msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, raw):
+        return self.msgpack.unpackb(raw, raw=False)
+
+
+serializers = {
+    'json': JSONSerializer,
+    'msgpack': MsgpackSerializer,
+}
+
+
+def get_serializer():
+    if not hasattr(current_app, 'cache_serializer'):
+        name = current_app.config.get('CACHE_SERIALIZER', 'json')
+        current_app.cache_serializer = serializers[name]()
+
+    return current_app.cache_serializer
 
 
 def get_redis():
     if not hasattr(current_app, 'redis'):
         host, port = current_app.config["REDIS_CONN"]
-        cache = RedisCache(host, port, default_timeout=300)
-
-        current_app.redis = cache
+        current_app.redis = redis.StrictRedis(host=host, port=port)
 
     return current_app.redis
 
 
-def get_cached_user_data(token):
-    # Gets cached user data.
-    r = get_redis()
-    key = "user" + json.dumps(token, sort_keys=True)
-    d = r.get(key)
-    if d:
-        return json.loads(d)
+def get_local_cache():
+    if not hasattr(current_app, 'local_cache'):
+        config = current_app.config
+        local = LocalCache(maxsize=config.get('LOCAL_CACHE_SIZE', 1024),
+                           ttl=config.get('LOCAL_CACHE_TTL', 30))
 
+        channel = config.get('CACHE_INVALIDATION_CHANNEL')
+        if channel:
+            def handler(message):
+                local.delete(message['data'].decode('utf-8'))
 
-def set_cached_user_data(token, data, expiration=300):
-    r = get_redis()
-    key = "user" + json.dumps(token, sort_keys=True)
-    r.set(key, json.dumps(data), timeout=expiration)
-    return data
+            pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{channel: handler})
+            pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+        current_app.local_cache = local
 
+    return current_app.local_cache
+
+
+def _get(key, decode, use_local=True, local_ttl=None):
+    """Reads a key through the local tier.
+
+    ``local_ttl`` is called with the decoded value and returns how long the
+    local tier may keep it, nothing is kept locally if it is not positive.
+    """
+    local = get_local_cache()
+    data = local.get(key) if use_local else None
+    if data is not None:
+        return data
+
+    raw = get_redis().get(key)
+    if raw:
+        data = decode(get_serializer().loads(raw))
+        ttl = local_ttl(data) if local_ttl is not None else None
+        if ttl is None or ttl > 0:
+            local.set(key, data, ttl=ttl)
+        return data
+
+
+def _set(key, data, encode, expiration, local_ttl=None):
+    get_redis().set(key, get_serializer().dumps(encode(data)), ex=expiration)
+    get_local_cache().set(key, data, ttl=expiration if local_ttl is None else local_ttl)
+
+
+def invalidate(*keys):
+    """Removes keys from Redis and from the local tier of every worker."""
+    if not keys:
+        return
 
-def get_cached_server_data(token):
     r = get_redis()
-    key = "server" + json.dumps(token, sort_keys=True)
-    d = r.get(key)
-    if d:
-        return json.loads(d)
+    r.delete(*keys)
+
+    local = get_local_cache()
+    channel = current_app.config.get('CACHE_INVALIDATION_CHANNEL')
+    for key in keys:
+        local.delete(key)
+        if channel:
+            r.publish(channel, key)
+
 
+def single_flight(key, fetch, encode, decode, expiration=300, stale=3600, wait=2.0, fallback_on=()):
+    """Returns the cached value of ``key``, calling ``fetch`` when it expired.
+
+    Only one worker at a time calls ``fetch`` for a key, guarded by a Redis
+    lock. While it does, the others serve the previous value for up to
+    ``stale`` seconds past its ``expiration``. If there is none, they wait up to
+    ``wait`` seconds for the fetch to finish. ``fetch`` may return ``None``,
+    which is never cached. If it raises one of the ``fallback_on`` exceptions
+    the stale value is returned instead, if there is one.
+    """
+    encode_entry = lambda entry: [entry[0], encode(entry[1])]
+    decode_entry = lambda entry: (entry[0], decode(entry[1]))
+    # the local tier only ever holds fresh entries, stale ones are always checked against Redis
+    fresh_for = lambda entry: entry[0] - time.time()
+
+    entry = _get(key, decode_entry, local_ttl=fresh_for)
+    if entry is not None and fresh_for(entry) > 0:
+        return entry[1]
 
-def set_cached_server_data(token, data, expiration=300):
     r = get_redis()
-    key = "server" + json.dumps(token, sort_keys=True)
-    r.set(key, json.dumps(data), timeout=expiration)
+    lock = 'lock:' + key
+    if r.set(lock, 1, nx=True, px=int(wait * 5000)):
+        # another worker may have revalidated between our read and taking the lock
+        latest = _get(key, decode_entry, use_local=False, local_ttl=fresh_for)
+        if latest is not None and fresh_for(latest) > 0:
+            r.delete(lock)
+            return latest[1]
+
+        try:
+            data = fetch()
+        except fallback_on:
+            if entry is None:
+                raise
+            return entry[1]
+        finally:
+            r.delete(lock)
+
+        if data is not None:
+            _set(key, (time.time() + expiration, data), encode_entry, expiration + stale, local_ttl=expiration)
+        return data
+
+    if entry is not None:
+        # someone else is revalidating, a slightly stale copy will do
+        return entry[1]
+
+    deadline = time.time() + wait
+    while time.time() < deadline:
+        time.sleep(0.05)
+        entry = _get(key, decode_entry, use_local=False)
+        if entry is not None:
+            return entry[1]
+
+    # the other fetch is taking too long, do it ourselves
+    return fetch()
+
+
+def token_digest(token):
+    """A short, stable identifier for an OAuth2 token.
+
+    Only the access token is hashed so the key does not depend on the
+    refresh token or the expiry bookkeeping stored next to it.
+    """
+    access_token = token['access_token'].encode('utf-8')
+    return hashlib.sha256(access_token).hexdigest()[:32]
+
+
+def identity(token, sid=None):
+    """Returns what the Discord data of a login is cached under.
+
+    A server-side session ID outlives token refreshes, so data cached under it
+    stays valid when the token changes.
+    """
+    if sid is not None:
+        return 'sid:' + sid
+    return token_digest(token)
+
+
+def _user_key(token, sid=None):
+    return "user:" + identity(token, sid)
+
+
+def _server_key(token, sid=None):
+    return "server:" + identity(token, sid)
+
+
+def _encode_user(data):
+    return _pack(USER_FIELDS, data)
+
+
+def _decode_user(row):
+    return _unpack(USER_FIELDS, row)
+
+
+def _encode_servers(data):
+    return [_pack(GUILD_FIELDS, entry) for entry in data]
+
+
+def _decode_servers(rows):
+    return [_unpack(GUILD_FIELDS, row) for row in rows]
+
+
+def invalidate_token(token, sid=None):
+    """Drops all cached Discord data associated with an OAuth2 token."""
+    if token is not None:
+        invalidate(_user_key(token, sid), _server_key(token, sid))
+
+
+def user_data(token, fetch, fallback_on=(), sid=None):
+    """Returns the Discord user payload for a token, see :func:`single_flight`."""
+    return single_flight(_user_key(token, sid), fetch, _encode_user, _decode_user, fallback_on=fallback_on)
+
+
+def server_data(token, fetch, fallback_on=(), sid=None):
+    """Returns the Discord guild list payload for a token, see :func:`single_flight`."""
+    return single_flight(_server_key(token, sid), fetch, _encode_servers, _decode_servers,
+                         fallback_on=fallback_on)
+
+
+def _generation_key(scope):
+    return 'fragment:%s:gen' % scope
+
+
+def fragment_generation(scope):
+    """Returns the current generation of a scope, it changes whenever the scope is invalidated."""
+    return int(get_redis().get(_generation_key(scope)) or 0)
+
+
+def cached_fragment(scopes, key, render, expiration=600):
+    """Returns a rendered fragment, calling ``render`` on a cache miss.
+
+    ``scopes`` are the data the fragment depends on, see :func:`invalidate_fragments`.
+    """
+    generations = get_redis().mget([_generation_key(scope) for scope in scopes])
+    versions = '.'.join((g or b'0').decode('utf-8') for g in generations)
+    full_key = 'fragment:%s:%s:%s' % ('+'.join(scopes), versions, key)
+
+    html = _get(full_key, str)
+    if html is None:
+        html = render()
+        _set(full_key, str(html), str, expiration)
+
+    return Markup(html)
+
+
+def invalidate_fragments(scopes):
+    """Retires every cached fragment rendered from the given scopes."""
+    with get_redis().pipeline() as pipe:
+        for scope in set(scopes):
+            pipe.incr(_generation_key(scope))
+            # outlives any fragment so a generation is never reused
+            pipe.expire(_generation_key(scope), 86400)
+        pipe.execute()
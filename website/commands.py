@@ -0,0 +1,108 @@
+"""
+Command line interface for the background workers and maintenance tasks.
+
+These are registered on the application in :func:`website.create_app` and
+run with ``flask <command>``.
+"""
+import socket
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+from flask import current_app
+from flask.cli import AppGroup, with_appcontext
+
+from . import bulk, derivatives, models, outbox, reaper, storage, tokens
+
+emotes = AppGroup('emotes', help='Emote maintenance commands.')
+
+
+@click.command('outbox')
+@click.option('--batch-size', default=50, help='Maximum number of queued messages handled at once.')
+@click.option('--max-attempts', default=5, help='Attempts before a message is dropped.')
+@click.option('--name', default=socket.gethostname, help='Unique name of this worker, keep it across restarts.')
+@with_appcontext
+def outbox_command(batch_size, max_attempts, name):
+    """Delivers queued bot notifications."""
+    outbox.run(name, batch_size=batch_size, max_attempts=max_attempts)
+
+
+@click.command('reaper')
+@click.option('--batch-size', default=500, help='Maximum number of files removed at once.')
+@click.option('--sweep-interval', default=3600, help='Seconds between orphaned file sweeps.')
+@click.option('--sweep-only', is_flag=True, help='Run a single sweep and exit.')
+@with_appcontext
+def reaper_command(batch_size, sweep_interval, sweep_only):
+    """Removes the files of deleted emotes."""
+    if sweep_only:
+        click.echo('Removed %s orphaned files.' % reaper.sweep())
+        return
+
+    reaper.run(batch_size=batch_size, sweep_interval=sweep_interval)
+
+
+@click.command('tokens')
+@click.option('--batch-size', default=50, help='Maximum number of tokens refreshed at once.')
+@click.option('--interval', default=30, help='Seconds between checks for tokens due for a refresh.')
+@with_appcontext
+def tokens_command(batch_size, interval):
+    """Refreshes OAuth2 tokens of server-side sessions before they expire."""
+    tokens.run(batch_size=batch_size, interval=interval)
+
+
+@emotes.command('migrate-blobs')
+def migrate_blobs_command():
+    """Moves emote files from per-guild folders into the blob store."""
+    moved, deduplicated = storage.import_legacy()
+    click.echo('Moved %s files, removed %s duplicates.' % (moved, deduplicated))
+
+
+@emotes.command('migrate-storage')
+@click.option('--source', default='local', type=click.Choice(['local', 's3']), help='Backend to copy from.')
+@click.option('--dest', default='s3', type=click.Choice(['local', 's3']), help='Backend to copy to.')
+@click.option('--workers', default=8, help='Maximum number of files copied at once.')
+def migrate_storage_command(source, dest, workers):
+    """Copies emote files between storage backends, set EMOTE_STORAGE to the destination afterwards."""
+    if source == dest:
+        raise click.BadParameter('The source and destination backends must differ.')
+
+    config = current_app.config
+    copied, skipped = storage.copy_blobs(storage.make_backend(source, config), storage.make_backend(dest, config),
+                                         workers=workers)
+    click.echo('Copied %s files, %s were already there.' % (copied, skipped))
+
+
+@emotes.command('derivatives')
+@click.option('--force', is_flag=True, help='Render variants even if they already exist.')
+def derivatives_command(force):
+    """Renders resized variants of every stored emote."""
+    filenames = [filename for filename, in models.db.session.query(models.Emote.filename).distinct()]
+    count = derivatives.backfill(filenames, force=force)
+    click.echo('Rendered variants for %s emotes.' % count)
+
+
+@emotes.command('import')
+@click.argument('guild_id', type=int)
+@click.argument('source', type=click.Path(exists=True))
+@click.option('--private', is_flag=True, help='Do not share the imported emotes.')
+@click.option('--workers', default=4, help='Processes validating images.')
+def import_command(guild_id, source, private, workers):
+    """Imports emotes into a guild from a ZIP archive or a directory of images."""
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        try:
+            imported, errors = bulk.import_emotes(guild_id, source, current_app.config['EMOTE_MAX_BYTES'], executor,
+                                                  shared=not private)
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+
+    for filename, error in sorted(errors.items()):
+        click.echo('Skipped %s: %s' % (filename, error), err=True)
+    click.echo('Imported %s emotes.' % len(imported))
+
+
+@emotes.command('export')
+@click.argument('guild_id', type=int)
+@click.argument('output', type=click.File('wb'))
+def export_command(guild_id, output):
+    """Writes a guild's emotes to a ZIP archive."""
+    for chunk in bulk.export_emotes(guild_id):
+        output.write(chunk)
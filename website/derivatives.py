@@ -0,0 +1,163 @@
+"""
+Pre-resized variants of emote images.
+
+Every stored emote gets WebP and PNG copies at each of :data:`SIZES` so pages
+can reference an image of the size they display. Pillow work runs in a process
+pool so it never blocks a request worker, or inline when ``DERIVATIVE_WORKERS``
+is 0. Variants are stored next to the original blob as ``<hash>.<size>.<ext>``.
+
+The hashes whose variants are all stored are kept in a Redis set, so serving a
+variant never has to ask the storage backend whether it exists (a network round
+trip with S3).
+"""
+import io
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+
+from flask import current_app, has_app_context, url_for
+from PIL import Image
+
+from .cache import get_redis
+from . import images, storage
+
+SIZES = (32, 48, 128)
+
+# file extension -> Pillow format name
+FORMATS = {
+    'webp': 'WEBP',
+    'png': 'PNG',
+}
+
+RENDERED_KEY = 'derivatives:rendered'
+
+
+def derivative_name(filename, size, ext):
+    digest = filename.split('.', 1)[0]
+    return '%s.%s.%s' % (digest, size, ext)
+
+
+def is_derivative(filename):
+    return filename.count('.') == 2
+
+
+def is_rendered(filename):
+    """Returns whether the variants of a blob, or of the blob a variant is rendered from, are stored."""
+    return get_redis().sismember(RENDERED_KEY, filename.split('.', 1)[0])
+
+
+def forget(filenames):
+    """Records that the variants of removed blobs are gone."""
+    digests = {filename.split('.', 1)[0] for filename in filenames}
+    if digests:
+        get_redis().srem(RENDERED_KEY, *digests)
+
+
+def source_of(filename):
+    """Returns the original blob a variant is rendered from, if it exists."""
+    digest = filename.split('.', 1)[0]
+    for ext in images.FORMATS.values():
+        original = '%s.%s' % (digest, ext)
+        if storage.exists(original):
+            return original
+
+
+def render(data):
+    """Renders every variant of an image.
+
+    This runs in a pool process. Returns a dict mapping derivative name
+    suffixes, e.g. ``'48.webp'``, to the encoded bytes.
+    """
+    image = Image.open(io.BytesIO(data))
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA')
+
+    rendered = {}
+    for size in SIZES:
+        resized = image.copy()
+        # thumbnail never upscales so small emotes are kept as they are
+        resized.thumbnail((size, size), Image.LANCZOS)
+        for ext, format in FORMATS.items():
+            out = io.BytesIO()
+            resized.save(out, format=format)
+            rendered['%s.%s' % (size, ext)] = out.getvalue()
+
+    return rendered
+
+
+class InlineExecutor(Executor):
+    """Runs submitted calls right away in the calling thread."""
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+
+def get_pool():
+    if not hasattr(current_app, 'derivative_pool'):
+        workers = current_app.config.get('DERIVATIVE_WORKERS', 2)
+        # with 0 workers images are processed in the request, process pools don't mix with gevent
+        current_app.derivative_pool = ProcessPoolExecutor(max_workers=workers) if workers else InlineExecutor()
+
+    return current_app.derivative_pool
+
+
+def store(filename, rendered):
+    digest = filename.split('.', 1)[0]
+    for suffix, data in rendered.items():
+        storage.save_blob('%s.%s' % (digest, suffix), data)
+    get_redis().sadd(RENDERED_KEY, digest)
+
+
+def schedule(filename, data):
+    """Renders the variants of a stored blob in the background."""
+    app = current_app._get_current_object()
+
+    def done(future):
+        try:
+            rendered = future.result()
+        except Exception:
+            app.logger.exception('Failed to render variants of %s', filename)
+            return
+
+        if has_app_context():
+            # run inline (see InlineExecutor), a nested context would tear down the caller's db session
+            store(filename, rendered)
+            return
+
+        with app.app_context():
+            store(filename, rendered)
+
+    get_pool().submit(render, data).add_done_callback(done)
+
+
+def backfill(filenames, force=False):
+    """Renders missing variants for existing blobs, returns how many blobs were processed."""
+    pending = {}
+    for filename in filenames:
+        if not force and all(storage.exists(derivative_name(filename, size, ext))
+                             for size in SIZES for ext in FORMATS):
+            # rendered before the set was kept
+            get_redis().sadd(RENDERED_KEY, filename.split('.', 1)[0])
+            continue
+
+        try:
+            pending[filename] = storage.read_blob(filename)
+        except OSError:
+            current_app.logger.warning('Blob %s is missing', filename)
+
+    pool = get_pool()
+    for filename, rendered in zip(pending, pool.map(render, pending.values())):
+        store(filename, rendered)
+
+    return len(pending)
+
+
+def emote_url(emote, size=None, ext='png'):
+    """Returns the URL of an emote image, or of one of its variants if ``size`` is given."""
+    filename = emote.filename
+    if size is not None:
+        filename = derivative_name(filename, size, ext)
+    return url_for('main.static_emote', guild_id=emote.owner_id, filename=filename)
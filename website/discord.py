@@ -5,29 +5,41 @@ import requests
 
 from . import cache
 from . import models
+from . import ratelimit
+from . import tokens
+from . import transport
 
 DISCORD_API_URL         = 'https://discordapp.com/api'
 DISCORD_AUTH_BASE_URL   = DISCORD_API_URL + '/oauth2/authorize'
 DISCORD_TOKEN_URL       = DISCORD_API_URL + '/oauth2/token'
 
 
+def session_id():
+    """Returns the ID of a server-side session, ``None`` with cookie sessions."""
+    return getattr(session, 'sid', None)
+
 def token_updater(token):
+    if session_id() is None:
+        # the old token is dead, make sure no worker keeps serving data keyed by it
+        cache.invalidate_token(session.get('oauth2_token'))
     session['oauth2_token'] = token
+    tokens.schedule(session_id(), token)
 
 def make_session(token=None, state=None):
     client_id = app.config['OAUTH2_CLIENT_ID']
     secret = app.config['OAUTH2_SECRET_KEY']
-    return OAuth2Session(client_id=app.config['OAUTH2_CLIENT_ID'],
-                         token=token,
-                         state=state,
-                         scope=['identify', 'email', 'guilds'],
-                         token_updater=token_updater,
-                         auto_refresh_url=DISCORD_TOKEN_URL,
-                         auto_refresh_kwargs={
-                            'client_id': client_id,
-                            'client_secret': secret
-                         },
-                         redirect_uri=app.config['OAUTH2_REDIRECT_URI'])
+    discord = OAuth2Session(client_id=app.config['OAUTH2_CLIENT_ID'],
+                            token=token,
+                            state=state,
+                            scope=['identify', 'email', 'guilds'],
+                            token_updater=token_updater,
+                            auto_refresh_url=DISCORD_TOKEN_URL,
+                            auto_refresh_kwargs={
+                               'client_id': client_id,
+                               'client_secret': secret
+                            },
+                            redirect_uri=app.config['OAUTH2_REDIRECT_URI'])
+    return transport.mount(discord)
 
 class User:
     def __init__(self, data):
@@ -46,19 +58,23 @@ class User:
         if token is None:
             return None
 
-        with make_session(token=token) as discord:
-            data = cache.get_cached_user_data(token)
-            if data is None:
-                user = discord.get(DISCORD_API_URL + '/users/@me')
-                if user.status_code == 401:
-                    # our token is invalidated
-                    session.pop('oauth2_token')
-                    return None
-
-                data = user.json()
-                cache.set_cached_user_data(token, data)
+        def fetch():
+            with make_session(token=token) as discord:
+                user = ratelimit.request(discord, 'GET', DISCORD_API_URL + '/users/@me',
+                                         bucket='users/@me:' + cache.token_digest(token))
+            return user.json() if user.status_code == 200 else None
+
+        try:
+            data = cache.user_data(token, fetch, fallback_on=ratelimit.RateLimited, sid=session_id())
+        except ratelimit.Unauthorized:
+            # our token is invalidated
+            session.pop('oauth2_token', None)
+            return None
+        except ratelimit.RateLimited:
+            # we're not logged out, Discord just can't tell us who we are right now
+            return None
 
-            return cls(data) if data else None
+        return cls(data) if data else None
 
     @property
     def avatar_url(self):
@@ -82,32 +98,35 @@ class BriefGuild:
         if token is None:
             return []
 
-        with make_session(token=token) as discord:
-            servers = cache.get_cached_server_data(token)
-            if servers is None:
-                guilds = discord.get(DISCORD_API_URL + '/users/@me/guilds')
-                if guilds.status_code != 200:
-                    session.pop('oauth2_token')
-                    return []
-
-                data = guilds.json()
-                cache.set_cached_server_data(token, data)
-
-            else:
-                data = servers
-
-            ret = []
+        def fetch():
+            with make_session(token=token) as discord:
+                guilds = ratelimit.request(discord, 'GET', DISCORD_API_URL + '/users/@me/guilds',
+                                           bucket='users/@me/guilds:' + cache.token_digest(token))
+            if guilds.status_code != 200:
+                return None
+
+            data = guilds.json()
+            # update the database with the guild info now that it's fresh
+            models.Guild.upsert_from([cls(entry) for entry in data if cls.can_manage(entry)])
+            return data
+
+        try:
+            data = cache.server_data(token, fetch, fallback_on=ratelimit.RateLimited, sid=session_id())
+        except ratelimit.Unauthorized:
+            session.pop('oauth2_token', None)
+            return []
+        except ratelimit.RateLimited:
+            return []
 
-            for entry in data:
-                # check if the user has MANAGE_GUILD in
-                if entry['permissions'] & 0x00000020 == 0x00000020:
-                    ret.append(cls(entry))
+        if data is None:
+            return []
 
-            # update the database with the guild info if needed
-            if servers is None:
-                models.Guild.upsert_from(ret)
+        return [cls(entry) for entry in data if cls.can_manage(entry)]
 
-            return ret
+    @staticmethod
+    def can_manage(entry):
+        # check if the user has MANAGE_GUILD in
+        return entry['permissions'] & 0x00000020 == 0x00000020
 
     @property
     def icon_url(self):
@@ -5,6 +5,8 @@ from wtforms.validators import DataRequired, Length, Regexp, ValidationError
 
 from .models import Emote, db
 
+EMOTE_NAME_PATTERN = r'^([a-zA-Z0-9][a-zA-Z0-9_]{2,19})$'
+
 def no_consecutive_underscores(form, field):
     if '__' in field.data:
         raise ValidationError("Emote name must not have consecutive underscores.")
@@ -17,7 +19,7 @@ class EmoteUploadForm(Form):
     emote  = FileField('Emote', validators=[DataRequired()])
     name   = StringField('Name', validators=[DataRequired(),
                                              Length(min=3, max=20),
-                                             Regexp(r'^([a-zA-Z0-9][a-zA-Z0-9_]{2,19})$',
+                                             Regexp(EMOTE_NAME_PATTERN,
                                                     message="Emote name must be alphanumeric with underscores and must "
                                                             "not start with an underscore."),
                                              no_consecutive_underscores,
@@ -0,0 +1,88 @@
+"""
+Validation of uploaded emote images.
+
+Uploads are read in chunks and hashed as they come in. Only the image header
+is parsed before the format and dimensions are checked, so oversized images
+(and decompression bombs) are rejected without ever being decoded. Accepted
+images are re-encoded, which drops metadata (EXIF, GPS...) and anything
+appended after the image data.
+"""
+import hashlib
+import io
+
+from PIL import Image
+
+# Pillow format name -> file extension
+FORMATS = {
+    'JPEG': 'jpg',
+    'PNG': 'png',
+}
+
+MAX_DIMENSION = 128
+CHUNK_SIZE = 64 * 1024
+
+
+class ValidatedImage:
+    def __init__(self, data, digest, format, width, height):
+        self.data = data
+        self.digest = digest
+        self.format = format
+        self.width = width
+        self.height = height
+
+    @property
+    def filename(self):
+        return '{}.{}'.format(self.digest, FORMATS[self.format])
+
+
+def read_upload(stream, limit):
+    """Reads at most ``limit`` bytes from ``stream``, returning ``(data, sha224 hexdigest)``."""
+    sha224 = hashlib.sha224()
+    buffer = io.BytesIO()
+    size = 0
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+
+        size += len(chunk)
+        if size > limit:
+            raise RuntimeError('File too large (expected %s KiB or less)' % (limit // 1024))
+
+        sha224.update(chunk)
+        buffer.write(chunk)
+
+    return buffer.getvalue(), sha224.hexdigest()
+
+
+def validate(stream, limit):
+    """Validates an uploaded emote image.
+
+    Raises :exc:`RuntimeError` with a user facing message if the image is
+    rejected, otherwise returns a :class:`ValidatedImage`.
+    """
+    data, digest = read_upload(stream, limit)
+
+    try:
+        # this only parses the header, no pixel data is decoded yet
+        image = Image.open(io.BytesIO(data))
+    except Exception:
+        raise RuntimeError('Invalid image')
+
+    if image.format not in FORMATS:
+        raise RuntimeError('Unsupported file extension (.%s).' % image.format)
+
+    if image.width > MAX_DIMENSION or image.height > MAX_DIMENSION:
+        raise RuntimeError('Image too big (got %sx%s and expected %sx%s or lower)' % (image.width, image.height,
+                                                                                       MAX_DIMENSION, MAX_DIMENSION))
+
+    try:
+        # decode the (small) image fully so truncated or corrupt files are caught
+        image.load()
+    except Exception:
+        raise RuntimeError('Invalid image')
+
+    # only the pixels are kept, the file is still named after the upload's hash
+    out = io.BytesIO()
+    image.save(out, format=image.format)
+    return ValidatedImage(out.getvalue(), digest, image.format, image.width, image.height)
@@ -1,41 +1,64 @@
-from flask import current_app as app
 from flask_sqlalchemy import SignallingSession, SQLAlchemy
 from flask_migrate import Migrate
 from sqlalchemy import event
+from sqlalchemy.dialects import postgresql
 from sqlalchemy import inspect
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.unitofwork import UOWTransaction
 
-import os
-import requests
+import hashlib
+import json
+
+from .cache import get_redis, invalidate_fragments
+from . import outbox
+from . import reaper
+from . import storage
 
 db = SQLAlchemy()
 migrate = Migrate()
 
-def send_message(guild_id, content):
-    token = app.config.get('BOT_TOKEN')
-    if token is None:
-        return
+def defer(session, kind, *items):
+    """Schedules work to run only once the session's transaction commits.
 
-    headers = {
-        'Authorization': 'Bot %s' % token,
-    }
-    url = 'https://discordapp.com/api/v6/channels/%s/messages' % guild_id
-    payload = {
-        'content': str(content),
-        'tts': False
-    }
-    r = requests.post(url, headers=headers, json=payload)
+    Items are grouped by ``kind`` and handed in bulk to the matching entry in
+    :data:`after_commit_handlers`. A rollback discards them.
+    """
+    deferred = session.info.setdefault('deferred', {})
+    deferred.setdefault(kind, []).extend(items)
 
-    if r.status_code == 200:
-        return r.json()
+def send_message(session, guild_id, content):
+    """Queues a bot message to be delivered after the current transaction commits."""
+    defer(session, 'messages', (guild_id, content))
 
-    return None
+after_commit_handlers = {
+    'messages': outbox.enqueue,
+    'unlinks': reaper.bury,
+}
 
 shared_emotes_link = db.Table('shared_emotes_link',
     db.Column('guild_id', db.BigInteger, db.ForeignKey('guild.id'), index=True, nullable=False),
-    db.Column('emote_id', db.Integer, db.ForeignKey('emote.id'), index=True, nullable=False)
+    db.Column('emote_id', db.Integer, db.ForeignKey('emote.id'), index=True, nullable=False),
+    db.UniqueConstraint('guild_id', 'emote_id', name='uq_shared_emotes_link')
 )
 
+MAX_GUILD_EMOTES = 10
+
+class KeysetPage:
+    """A page of results paginated by ID rather than by offset."""
+
+    def __init__(self, items, has_prev, has_next):
+        self.items = items
+        self.has_prev = has_prev and bool(items)
+        self.has_next = has_next and bool(items)
+
+    @property
+    def prev_cursor(self):
+        return self.items[0].id if self.has_prev else None
+
+    @property
+    def next_cursor(self):
+        return self.items[-1].id if self.has_next else None
+
 class Emote(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     shared = db.Column(db.Boolean, index=True, nullable=False, default=False)
@@ -44,10 +67,22 @@ class Emote(db.Model):
     verified = db.Column(db.Boolean, index=True, default=False)
     # SHA-224 is 224 bits, 4 bits per hex code means 224 / 4 = 56 characters
     # then we add 4 for the extension and we get a maximum of 60 characters.
-    filename = db.Column(db.String(60))
+    # Files are stored once per hash and shared between guilds, see storage.py.
+    filename = db.Column(db.String(60), index=True)
 
     shared_guilds = db.relationship('Guild', secondary=shared_emotes_link, backref=db.backref('shared_emotes'))
 
+    __table_args__ = (
+        # partial index that serves the shared library in id order
+        db.Index('ix_emote_library', 'id',
+                 postgresql_where=db.and_(shared == True, verified == True),
+                 sqlite_where=db.and_(shared == True, verified == True)),
+        # partial index that serves the moderation queue, oldest first
+        db.Index('ix_emote_unverified', 'id',
+                 postgresql_where=db.or_(verified == False, verified == None),
+                 sqlite_where=db.or_(verified == False, verified == None)),
+    )
+
     def __repr__(self):
         return '<Emote id={0.id} name={0.name} shared={0.shared}>'.format(self)
 
@@ -55,44 +90,104 @@ class Emote(db.Model):
     def all_shared_emotes(cls):
         return cls.query.filter_by(shared=True, verified=True)
 
+    @classmethod
+    def library_page(cls, per_page, after=None, before=None):
+        """Returns a :class:`KeysetPage` of shared emotes ordered by ID.
+
+        ``after`` and ``before`` are emote ID cursors from a previous page.
+        """
+        query = cls.all_shared_emotes()
+        if before is not None:
+            items = query.filter(cls.id < before).order_by(cls.id.desc()).limit(per_page + 1).all()
+            has_prev = len(items) > per_page
+            return KeysetPage(items[:per_page][::-1], has_prev=has_prev, has_next=True)
+
+        if after is not None:
+            query = query.filter(cls.id > after)
+        items = query.order_by(cls.id).limit(per_page + 1).all()
+        return KeysetPage(items[:per_page], has_prev=after is not None, has_next=len(items) > per_page)
+
+    def public_shared_guilds(self):
+        """Returns the public guilds this emote is shared with."""
+        return Guild.query.join(shared_emotes_link, shared_emotes_link.c.guild_id == Guild.id) \
+                          .filter(shared_emotes_link.c.emote_id == self.id, Guild.public == True) \
+                          .order_by(Guild.id).all()
+
+    @classmethod
+    def pending_review(cls):
+        return cls.query.filter(_not_verified())
+
+    @classmethod
+    def moderation_queue(cls, per_page, after=None):
+        """Returns a :class:`KeysetPage` of unverified emotes, oldest first."""
+        query = cls.pending_review()
+        if after is not None:
+            query = query.filter(cls.id > after)
+        items = query.order_by(cls.id).limit(per_page + 1).all()
+        return KeysetPage(items[:per_page], has_prev=after is not None, has_next=len(items) > per_page)
+
     def path(self):
-        return os.path.join(str(self.owner_id), self.filename)
+        return storage.blob_path(self.filename)
 
 class Guild(db.Model):
     id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
     icon = db.Column(db.String)
     name = db.Column(db.String)
     public = db.Column(db.Boolean, default=True)
+    # owned plus shared emotes, maintained by the flush hooks below
+    emote_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     @classmethod
     def upsert_from(cls, guilds):
-        cached = {s.id: s for s in guilds}
+        mappings = sorted(({'id': g.id, 'name': g.name, 'icon': g.icon} for g in guilds), key=lambda m: m['id'])
+        if not mappings:
+            return
+
+        # skip the write entirely if we persisted exactly this list recently
+        digest = hashlib.sha1(json.dumps(mappings, separators=(',', ':')).encode('utf-8')).hexdigest()
+        key = 'guilds:persisted:' + digest
+        r = get_redis()
+        if r.exists(key):
+            return
+
+        if db.engine.dialect.name == 'postgresql':
+            cls._upsert_postgresql(mappings)
+        else:
+            cls._upsert_portable(mappings)
 
-        # updates
+        db.session.commit()
+        r.set(key, 1, ex=3600)
+
+    @classmethod
+    def _upsert_postgresql(cls, mappings):
+        table = cls.__table__
+        stmt = postgresql.insert(table).values(mappings)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.id],
+            set_={'name': stmt.excluded.name, 'icon': stmt.excluded.icon},
+            # leave unchanged rows alone so they don't generate dead tuples
+            where=db.or_(table.c.name.is_distinct_from(stmt.excluded.name),
+                         table.c.icon.is_distinct_from(stmt.excluded.icon))
+        )
+        db.session.execute(stmt)
+
+    @classmethod
+    def _upsert_portable(cls, mappings):
+        cached = {m['id']: m for m in mappings}
+
+        # updates, only for rows that actually changed
         update_mappings = []
-        for existing in cls.query.filter(cls.id.in_(set(cached.keys()))).all():
-            new_guild = cached[existing.id]
-            mapping = {
-                'id': existing.id,
-                'name': new_guild.name,
-                'icon': new_guild.icon
-            }
-            update_mappings.append(mapping)
-            cached.pop(existing.id)
+        existing = db.session.query(cls.id, cls.name, cls.icon).filter(cls.id.in_(set(cached.keys())))
+        for guild_id, name, icon in existing:
+            new_guild = cached.pop(guild_id)
+            if (name, icon) != (new_guild['name'], new_guild['icon']):
+                update_mappings.append(new_guild)
 
         # inserts
-        insert_mappings = [
-            {
-                'id': guild.id,
-                'name': guild.name,
-                'icon': guild.icon
-            }
-            for guild in cached.values()
-        ]
+        insert_mappings = list(cached.values())
 
         db.session.bulk_update_mappings(cls, update_mappings)
         db.session.bulk_insert_mappings(cls, insert_mappings)
-        db.session.commit()
 
     @property
     def icon_url(self):
@@ -102,27 +197,95 @@ class Guild(db.Model):
         return 'https://cdn.discordapp.com/icons/{0.id}/{0.icon}.jpg'.format(self)
 
 
+def guild_emotes_query(guild_id: int):
+    """Returns a query for a guild's own and shared Emotes."""
+    shared = db.session.query(shared_emotes_link.c.emote_id).filter(shared_emotes_link.c.guild_id == guild_id)
+    return Emote.query.filter(db.or_(Emote.owner_id == guild_id, Emote.id.in_(shared)))
+
 def guild_emotes(guild_id: int):
     """Returns all a guild's Emotes based on ID. This returns both shared and unshared emotes."""
-    emotes = Emote.query.filter(Emote.owner_id==guild_id).all()
-    guild = Guild.query.get(guild_id)
-    if guild is not None:
-        emotes.extend(guild.shared_emotes)
-    return emotes
+    # owned emotes first, then the shared ones
+    return guild_emotes_query(guild_id).order_by(Emote.owner_id != guild_id, Emote.id).all()
+
+def lock_emote_quota(guild_id: int):
+    """Locks the guild's row and checks it can take another emote.
+
+    The lock is held until the end of the transaction so concurrent uploads
+    for the same guild are serialized. Raises :exc:`RuntimeError` if the guild
+    is full. Returns ``False`` if the guild is not known.
+    """
+    count = db.session.query(Guild.emote_count).filter(Guild.id == guild_id).with_for_update().scalar()
+    if count is None:
+        return False
+
+    if count >= MAX_GUILD_EMOTES:
+        raise RuntimeError('The guild has reached the maximum number of emotes.')
+    return True
 
 def add_shared_emote(guild_id: int, emote: Emote):
     """Utility that adds a shared Emote to a guild."""
-    guild = Guild.query.get(guild_id)
-    emotes = guild_emotes(guild_id)
-    if guild is not None:
-        if len(emotes) >= 10:
-            raise RuntimeError('The guild has reached the maximum number of emotes.')
+    if emote.owner_id == guild_id:
+        raise RuntimeError('This emote is already in the guild.')
 
-        if any(e.id == emote.id for e in emotes):
-            raise RuntimeError('This emote is already in the guild.')
+    try:
+        if not lock_emote_quota(guild_id):
+            return
+    except RuntimeError:
+        db.session.rollback()
+        raise
 
-        emote.shared_guilds.append(guild)
-        db.session.commit()
+    # insert the link directly rather than loading emote.shared_guilds to append to it,
+    # the unique constraint catches duplicates
+    try:
+        db.session.execute(shared_emotes_link.insert().values(guild_id=guild_id, emote_id=emote.id))
+    except IntegrityError:
+        db.session.rollback()
+        raise RuntimeError('This emote is already in the guild.')
+
+    db.session.execute(Guild.__table__.update().where(Guild.id == guild_id)
+                                       .values(emote_count=Guild.emote_count + 1))
+    defer(db.session(), 'fragments', 'guild:%s' % guild_id, 'emote:%s' % emote.id)
+    db.session.commit()
+
+def _adjust_emote_counts(session, deltas):
+    table = Guild.__table__
+    connection = session.connection()
+    for guild_id, delta in deltas.items():
+        if delta:
+            connection.execute(table.update().where(table.c.id == guild_id)
+                                             .values(emote_count=table.c.emote_count + delta))
+
+def _shared_guilds_history(emote):
+    """Returns ``(added, unchanged, deleted)`` lists of the guilds an emote is shared to.
+
+    SQLAlchemy reports ``None`` for an unloaded collection and tuples on delete.
+    """
+    history = inspect(emote).attrs.shared_guilds.history
+    return list(history.added or ()), list(history.unchanged or ()), list(history.deleted or ())
+
+def handle_emote_counts(session, flush_context):
+    # Keeps Guild.emote_count in sync with emotes and shared links changed through the ORM.
+    deltas = {}
+    for emote in session.new:
+        if isinstance(emote, Emote):
+            deltas[emote.owner_id] = deltas.get(emote.owner_id, 0) + 1
+
+    for emote in session.dirty:
+        if isinstance(emote, Emote):
+            added, _, deleted = _shared_guilds_history(emote)
+            for guild in added:
+                deltas[guild.id] = deltas.get(guild.id, 0) + 1
+            for guild in deleted:
+                deltas[guild.id] = deltas.get(guild.id, 0) - 1
+
+    for emote in session.deleted:
+        if isinstance(emote, Emote):
+            deltas[emote.owner_id] = deltas.get(emote.owner_id, 0) - 1
+            _, unchanged, deleted = _shared_guilds_history(emote)
+            for guild in unchanged + deleted:
+                deltas[guild.id] = deltas.get(guild.id, 0) - 1
+
+    _adjust_emote_counts(session, deltas)
 
 def handle_verifies(session, flush_context: UOWTransaction):
     # Handles verification checking on emotes.
@@ -133,11 +296,7 @@ def handle_verifies(session, flush_context: UOWTransaction):
 
         history = inspect(emote).attrs.verified.history
         if history.added and history.added[0]:
-            verified = True
-        else:
-            verified = False
-
-        # TODO: Do whatever with the verified status.
+            send_message(session, emote.owner_id, 'Emote "%s" has been verified and can now be used.' % emote.name)
 
 def handle_deletes(session, flush_context):
     # Delete all emotes in session.deleted
@@ -145,14 +304,217 @@ def handle_deletes(session, flush_context):
         if not isinstance(emote, Emote):
             continue
 
-        filename = os.path.join(app.config['UPLOAD_FOLDER'], emote.path())
-        try:
-            os.remove(filename)
-        except OSError:
-            pass
+        # the blob is only removed by the reaper once the delete has committed
+        # and no other emote references it
+        defer(session, 'unlinks', emote.filename)
+        send_message(session, emote.owner_id, 'Emote "%s" has been deleted and can no longer be used.' % emote.name)
+
+LIBRARY_COUNT_KEY = 'library:count'
+
+def library_count():
+    """Returns the number of emotes in the shared library.
+
+    The count is cached in Redis and kept up to date by :func:`handle_library_count`.
+    It expires every hour so any drift heals itself.
+    """
+    r = get_redis()
+    count = r.get(LIBRARY_COUNT_KEY)
+    if count is None:
+        count = Emote.all_shared_emotes().count()
+        r.set(LIBRARY_COUNT_KEY, count, ex=3600)
+    return int(count)
+
+def adjust_library_count(deltas):
+    r = get_redis()
+    if None in deltas:
+        # a change we could not account for, recount on next access
+        r.delete(LIBRARY_COUNT_KEY)
+        return
+
+    delta = sum(deltas)
+    if delta and r.exists(LIBRARY_COUNT_KEY):
+        r.incrby(LIBRARY_COUNT_KEY, delta)
+
+def _committed_value(emote, attr):
+    """Returns the database value of an attribute before this flush.
+
+    Raises :exc:`LookupError` if the old value was never loaded.
+    """
+    history = inspect(emote).attrs[attr].history
+    if history.deleted:
+        return history.deleted[0]
+    if history.added:
+        raise LookupError(attr)
+    return getattr(emote, attr)
+
+def _in_library(shared, verified):
+    return bool(shared) and bool(verified)
+
+def handle_library_count(session, flush_context):
+    # Tracks emotes entering and leaving the shared library.
+    delta = 0
+    for emote in session.new:
+        if isinstance(emote, Emote) and _in_library(emote.shared, emote.verified):
+            delta += 1
+
+    try:
+        for emote in session.dirty:
+            if isinstance(emote, Emote):
+                was = _in_library(_committed_value(emote, 'shared'), _committed_value(emote, 'verified'))
+                delta += _in_library(emote.shared, emote.verified) - was
+
+        for emote in session.deleted:
+            if isinstance(emote, Emote):
+                delta -= _in_library(_committed_value(emote, 'shared'), _committed_value(emote, 'verified'))
+    except LookupError:
+        defer(session, 'library_count', None)
+        return
+
+    if delta:
+        defer(session, 'library_count', delta)
+
+after_commit_handlers['library_count'] = adjust_library_count
+
+def _sharing_guild_scopes(session, emote_ids):
+    # every guild that has one of the emotes shared to it lists it too
+    if not emote_ids:
+        return set()
+    link = shared_emotes_link.c
+    rows = session.execute(db.select([link.guild_id]).where(link.emote_id.in_(list(emote_ids))).distinct())
+    return {'guild:%s' % guild_id for guild_id, in rows}
+
+def handle_fragments(session, flush_context):
+    # Works out which cached page fragments a flush makes stale.
+    scopes = set()
+    emote_ids = set()
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, Emote):
+            scopes.add('emote:%s' % obj.id)
+            scopes.add('guild:%s' % obj.owner_id)
+            if obj in session.dirty:
+                # guilds it was already shared to, added links are in the table too
+                emote_ids.add(obj.id)
+
+            # cheaper than working out whether the emote is, or was, in the library
+            scopes.add('library')
+
+            added, unchanged, deleted = _shared_guilds_history(obj)
+            guilds = added + deleted
+            if obj in session.deleted:
+                guilds += unchanged
+            scopes.update('guild:%s' % guild.id for guild in guilds)
+
+        elif isinstance(obj, Guild):
+            scopes.add('guild:%s' % obj.id)
+            # emote pages list the public guilds using them
+            scopes.add('emotes')
+
+    scopes |= _sharing_guild_scopes(session, emote_ids)
+    if scopes:
+        defer(session, 'fragments', *scopes)
+
+after_commit_handlers['fragments'] = invalidate_fragments
+
+# Bulk moderation
+#
+# These run as single UPDATE/DELETE statements over every emote matching a
+# criterion. Those bypass the flush hooks above, so each function applies
+# the same side effects explicitly, in batch. The caller commits.
+
+def _not_verified():
+    return db.or_(Emote.verified == False, Emote.verified == None)
+
+def _lock_matching(criterion):
+    # lock the rows so the side effects match what the statement changes
+    return db.session.query(Emote.id, Emote.owner_id, Emote.name, Emote.filename, Emote.shared, Emote.verified) \
+                     .filter(criterion).with_for_update().all()
+
+def _touch(session, rows):
+    scopes = _sharing_guild_scopes(session, [row.id for row in rows])
+    scopes.add('library')
+    for row in rows:
+        scopes.add('emote:%s' % row.id)
+        scopes.add('guild:%s' % row.owner_id)
+    defer(session, 'fragments', *scopes)
+
+def bulk_set_verified(criterion, verified: bool):
+    """Verifies or unverifies every matching emote, returns how many changed."""
+    session = db.session()
+    criterion = db.and_(criterion, _not_verified() if verified else Emote.verified == True)
+    rows = _lock_matching(criterion)
+    if not rows:
+        return 0
+
+    Emote.query.filter(criterion).update({'verified': verified}, synchronize_session=False)
+
+    shared = sum(1 for row in rows if row.shared)
+    defer(session, 'library_count', shared if verified else -shared)
+    _touch(session, rows)
+    if verified:
+        for row in rows:
+            send_message(session, row.owner_id, 'Emote "%s" has been verified and can now be used.' % row.name)
+    return len(rows)
+
+def bulk_unshare(criterion):
+    """Makes every matching emote private, returns how many changed."""
+    session = db.session()
+    criterion = db.and_(criterion, Emote.shared == True)
+    rows = _lock_matching(criterion)
+    if not rows:
+        return 0
+
+    Emote.query.filter(criterion).update({'shared': False}, synchronize_session=False)
+
+    defer(session, 'library_count', -sum(1 for row in rows if row.verified))
+    _touch(session, rows)
+    return len(rows)
+
+def bulk_delete(criterion):
+    """Deletes every matching emote, returns how many were deleted."""
+    session = db.session()
+    rows = _lock_matching(criterion)
+    if not rows:
+        return 0
+
+    ids = db.session.query(Emote.id).filter(criterion)
+    link = shared_emotes_link.c
+    links = db.session.query(link.guild_id, db.func.count()).filter(link.emote_id.in_(ids)) \
+                      .group_by(link.guild_id).all()
+
+    db.session.execute(shared_emotes_link.delete().where(link.emote_id.in_(ids)))
+    Emote.query.filter(criterion).delete(synchronize_session=False)
+
+    deltas = {}
+    for row in rows:
+        deltas[row.owner_id] = deltas.get(row.owner_id, 0) - 1
+    for guild_id, count in links:
+        deltas[guild_id] = deltas.get(guild_id, 0) - count
+    _adjust_emote_counts(session, deltas)
+
+    defer(session, 'library_count', -sum(1 for row in rows if _in_library(row.shared, row.verified)))
+    defer(session, 'unlinks', *{row.filename for row in rows})
+    defer(session, 'fragments', *('guild:%s' % guild_id for guild_id, _ in links))
+    _touch(session, rows)
+    for row in rows:
+        send_message(session, row.owner_id, 'Emote "%s" has been deleted and can no longer be used.' % row.name)
+
+    # drop any loaded instances, their rows are gone
+    db.session.expire_all()
+    return len(rows)
+
+def run_deferred(session):
+    deferred = session.info.pop('deferred', {})
+    for kind, items in deferred.items():
+        after_commit_handlers[kind](items)
 
-        send_message(emote.owner_id, 'Emote "%s" has been deleted and can no longer be used.' % emote.name)
+def discard_deferred(session):
+    session.info.pop('deferred', None)
 
 # register to SignallingSession instead of db.session otherwise an ArgumentError is raised
 event.listen(SignallingSession, "after_flush", handle_deletes)
 event.listen(SignallingSession, "after_flush", handle_verifies)
+event.listen(SignallingSession, "after_flush", handle_library_count)
+event.listen(SignallingSession, "after_flush", handle_fragments)
+event.listen(SignallingSession, "after_flush", handle_emote_counts)
+event.listen(SignallingSession, "after_commit", run_deferred)
+event.listen(SignallingSession, "after_rollback", discard_deferred)
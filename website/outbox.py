@@ -0,0 +1,180 @@
+"""
+Outbox for bot notifications.
+
+Messages are pushed onto a Redis list once the transaction that produced them
+has committed and are delivered by a background worker (``flask outbox``),
+so request latency never depends on Discord.
+
+A worker moves the messages it works on to its own processing list and only
+removes them once they are delivered, dropped or scheduled for a retry. A
+worker that dies mid-batch puts its leftovers back in the queue when it starts
+again under the same name.
+"""
+import json
+import time
+
+import redis
+from flask import current_app
+
+from .cache import get_redis
+from . import ratelimit
+from . import transport
+
+OUTBOX_KEY = 'outbox:messages'
+RETRY_KEY = 'outbox:retry'
+PROCESSING_KEY = 'outbox:processing:'
+
+# Discord rejects messages longer than this
+MAX_MESSAGE_LENGTH = 2000
+
+
+def enqueue(messages):
+    """Queues ``(channel_id, content)`` pairs for delivery."""
+    payloads = [json.dumps({'channel_id': channel_id, 'content': str(content), 'attempts': 0})
+                for channel_id, content in messages]
+    if payloads:
+        get_redis().rpush(OUTBOX_KEY, *payloads)
+
+
+def _pop_batch(r, processing, batch_size, timeout):
+    first = r.blmove(OUTBOX_KEY, processing, timeout, 'LEFT', 'RIGHT')
+    if first is None:
+        return []
+
+    with r.pipeline() as pipe:
+        for _ in range(batch_size - 1):
+            pipe.lmove(OUTBOX_KEY, processing, 'LEFT', 'RIGHT')
+        rest = [raw for raw in pipe.execute() if raw is not None]
+
+    messages = []
+    for raw in [first] + rest:
+        message = json.loads(raw.decode('utf-8'))
+        # what to remove from the processing list once the message is handled
+        message['raw'] = raw
+        messages.append(message)
+    return messages
+
+
+def _recover(r, processing):
+    """Puts messages left over by a previous run of this worker back at the front of the queue."""
+    count = 0
+    while r.lmove(processing, OUTBOX_KEY, 'RIGHT', 'LEFT') is not None:
+        count += 1
+    return count
+
+
+def _requeue_due(r):
+    with r.pipeline() as pipe:
+        try:
+            # moved in one transaction, so a crash can't lose them in between
+            pipe.watch(RETRY_KEY)
+            due = pipe.zrangebyscore(RETRY_KEY, '-inf', time.time())
+            if not due:
+                pipe.reset()
+                return
+            pipe.multi()
+            pipe.zrem(RETRY_KEY, *due)
+            pipe.rpush(OUTBOX_KEY, *due)
+            pipe.execute()
+        except redis.WatchError:
+            # another worker got to them first
+            pass
+
+
+def coalesce(messages):
+    """Groups messages per channel, joining them up to the message length limit.
+
+    Returns a list of ``(channel_id, content, originals)`` tuples.
+    """
+    per_channel = {}
+    for message in messages:
+        per_channel.setdefault(message['channel_id'], []).append(message)
+
+    batches = []
+    for channel_id, queued in per_channel.items():
+        content, originals = '', []
+        for message in queued:
+            candidate = message['content'] if not content else content + '\n' + message['content']
+            if originals and len(candidate) > MAX_MESSAGE_LENGTH:
+                batches.append((channel_id, content, originals))
+                content, originals = message['content'], []
+            else:
+                content = candidate
+            originals.append(message)
+
+        batches.append((channel_id, content, originals))
+
+    return batches
+
+
+def deliver(channel_id, content):
+    """Sends a message through the bot account.
+
+    Returns a ``(delivered, retry_after)`` tuple. ``retry_after`` is the
+    number of seconds to wait before retrying this channel, if known.
+    """
+    token = current_app.config.get('BOT_TOKEN')
+    if token is None:
+        # nothing to deliver with, drop it like we always did
+        return True, None
+
+    headers = {
+        'Authorization': 'Bot %s' % token,
+    }
+    url = 'https://discordapp.com/api/v6/channels/%s/messages' % channel_id
+    payload = {
+        'content': content,
+        'tts': False
+    }
+    try:
+        r = ratelimit.request(transport.get_session(), 'POST', url, bucket='channels/%s/messages' % channel_id,
+                              max_wait=5.0, headers=headers, json=payload)
+    except ratelimit.RateLimited as e:
+        return False, e.retry_after
+
+    if 500 <= r.status_code < 600:
+        return False, None
+
+    # anything else (including 403/404 for a channel we can't post in) is final,
+    # waiting for the bucket to refill is handled by the rate limiter
+    return True, None
+
+
+def run(name, batch_size=50, max_attempts=5, timeout=5):
+    """Delivers queued messages forever.
+
+    ``name`` identifies the worker's processing list and must be unique among
+    running workers, but stable across restarts.
+    """
+    r = get_redis()
+    logger = current_app.logger
+    processing = PROCESSING_KEY + name
+
+    recovered = _recover(r, processing)
+    if recovered:
+        logger.warning('Requeued %s messages left over by a previous run', recovered)
+
+    while True:
+        _requeue_due(r)
+        for channel_id, content, originals in coalesce(_pop_batch(r, processing, batch_size, timeout)):
+            try:
+                delivered, retry_after = deliver(channel_id, content)
+            except Exception:
+                logger.exception('Failed to deliver message to %s', channel_id)
+                delivered, retry_after = False, None
+
+            with r.pipeline() as pipe:
+                for message in originals:
+                    pipe.lrem(processing, 1, message.pop('raw'))
+                    if delivered:
+                        continue
+
+                    message['attempts'] += 1
+                    if message['attempts'] >= max_attempts:
+                        logger.error('Dropping message to %s after %s attempts', channel_id, max_attempts)
+                        continue
+
+                    backoff = retry_after or 2 ** message['attempts']
+                    pipe.zadd(RETRY_KEY, {json.dumps(message): time.time() + backoff})
+                # the retry and the removal happen together
+                pipe.execute()
@@ -0,0 +1,154 @@
+"""
+Rate limit aware requests to the Discord API.
+
+Discord limits requests per route bucket and globally, and reports the state
+of the bucket in the ``X-RateLimit-*`` headers of every response. The state is
+kept in Redis so every worker schedules its requests against the same budget.
+"""
+import time
+
+from .cache import get_redis
+
+GLOBAL_KEY = 'ratelimit:global'
+
+# Checks the global and the route bucket and takes a request from the bucket
+# if it is allowed. Returns how many seconds to wait, as a string since Lua
+# numbers are truncated to integers on the way out.
+#
+# When the state of the bucket is unknown or its window is over, a single
+# request goes through to learn the new state and holds the bucket for up to
+# ARGV[2] seconds. Everyone else waits for its response rather than firing
+# at once into a 429.
+ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local blocked = tonumber(redis.call('GET', KEYS[2]) or '0')
+if blocked > now then
+    return tostring(blocked - now)
+end
+
+local reset = tonumber(redis.call('HGET', KEYS[1], 'reset') or '0')
+if reset > now then
+    local remaining = tonumber(redis.call('HGET', KEYS[1], 'remaining') or '1')
+    if remaining <= 0 then
+        return tostring(reset - now)
+    end
+    redis.call('HINCRBY', KEYS[1], 'remaining', -1)
+    return '0'
+end
+
+local lease = tonumber(ARGV[2])
+redis.call('HMSET', KEYS[1], 'remaining', 0, 'reset', now + lease)
+redis.call('PEXPIRE', KEYS[1], math.ceil(lease * 1000))
+return '0'
+"""
+
+# how long a request learning the state of a bucket holds it
+PROBE_LEASE = 2.0
+
+
+class DiscordError(Exception):
+    """Base class for failed Discord API requests."""
+
+
+class RateLimited(DiscordError):
+    def __init__(self, retry_after, is_global=False):
+        self.retry_after = retry_after
+        self.is_global = is_global
+        super().__init__('Rate limited for %.2f seconds' % retry_after)
+
+
+class Unauthorized(DiscordError):
+    def __init__(self):
+        super().__init__('The token is no longer valid')
+
+
+def _bucket_key(bucket):
+    return 'ratelimit:bucket:' + bucket
+
+
+def acquire(bucket):
+    """Takes a request from the bucket, returns how long to wait first if it is empty."""
+    r = get_redis()
+    if not hasattr(r, 'ratelimit_script'):
+        r.ratelimit_script = r.register_script(ACQUIRE_SCRIPT)
+    wait = r.ratelimit_script(keys=[_bucket_key(bucket), GLOBAL_KEY], args=[time.time(), PROBE_LEASE])
+    return float(wait)
+
+
+def update(bucket, response):
+    """Records the bucket state reported by a response."""
+    r = get_redis()
+    headers = response.headers
+    now = time.time()
+
+    if response.status_code == 429:
+        try:
+            body = response.json()
+            # the unversioned API (v6) reports milliseconds
+            retry_after = body.get('retry_after', 1000) / 1000.0
+        except ValueError:
+            # not from the API itself, e.g. the Cloudflare ban page, only the header is left
+            body = {}
+            try:
+                retry_after = float(headers.get('Retry-After', 1))
+            except ValueError:
+                retry_after = 1.0
+        if body.get('global') or headers.get('X-RateLimit-Global'):
+            r.set(GLOBAL_KEY, now + retry_after, px=int(retry_after * 1000) + 1)
+            # the bucket itself was not the problem
+            r.delete(_bucket_key(bucket))
+        else:
+            key = _bucket_key(bucket)
+            with r.pipeline() as pipe:
+                pipe.hmset(key, {'remaining': 0, 'reset': now + retry_after})
+                pipe.expireat(key, int(now + retry_after) + 1)
+                pipe.execute()
+        return retry_after
+
+    remaining = headers.get('X-RateLimit-Remaining')
+    if remaining is None:
+        # not a rate limited route, or an error page: release the bucket
+        r.delete(_bucket_key(bucket))
+        return
+
+    if 'X-RateLimit-Reset-After' in headers:
+        reset = now + float(headers['X-RateLimit-Reset-After'])
+    else:
+        reset = float(headers.get('X-RateLimit-Reset', now))
+
+    key = _bucket_key(bucket)
+    with r.pipeline() as pipe:
+        pipe.hmset(key, {'remaining': int(remaining), 'reset': reset})
+        pipe.expireat(key, int(reset) + 1)
+        pipe.execute()
+
+
+def request(session, method, url, bucket, max_wait=1.0, **kwargs):
+    """Performs a request against the Discord API within its rate limits.
+
+    ``bucket`` identifies the rate limit the request counts against, e.g. the
+    route plus its major parameter or the token for ``/users/@me`` routes.
+    Waits up to ``max_wait`` seconds in total for the bucket to refill.
+
+    Raises :exc:`RateLimited` if the request can't be made in time or Discord
+    answered with a 429, and :exc:`Unauthorized` on a 401. Other responses are
+    returned as they are.
+    """
+    deadline = time.time() + max_wait
+    while True:
+        wait = acquire(bucket)
+        if wait <= 0:
+            break
+        # other waiters are competing for the refill, so only a zero wait means we hold a slot
+        if time.time() + wait > deadline:
+            raise RateLimited(wait)
+        time.sleep(wait)
+
+    response = session.request(method, url, **kwargs)
+    retry_after = update(bucket, response)
+
+    if response.status_code == 429:
+        raise RateLimited(retry_after, is_global=bool(get_redis().exists(GLOBAL_KEY)))
+    if response.status_code == 401:
+        raise Unauthorized()
+    return response
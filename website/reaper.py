@@ -0,0 +1,80 @@
+"""
+Deferred removal of emote files.
+
+Deleting an emote only records a tombstone for its blob once the transaction
+commits. The reaper worker (``flask reaper``) removes tombstoned blobs whose
+reference count dropped to zero in batches and periodically sweeps the blob
+store for files that no :class:`~website.models.Emote` references anymore.
+"""
+import time
+
+from flask import current_app
+
+from .cache import get_redis
+from . import models
+from . import derivatives, storage
+
+TOMBSTONE_KEY = 'reaper:tombstones'
+
+
+def bury(filenames):
+    """Marks blobs for removal once nothing references them."""
+    # emotes that never got a file have no blob to bury
+    filenames = [filename for filename in filenames if filename]
+    if filenames:
+        get_redis().sadd(TOMBSTONE_KEY, *filenames)
+
+
+def referenced_filenames(filenames=None):
+    """Returns the set of blob filenames still referenced by an emote."""
+    query = models.db.session.query(models.Emote.filename).distinct()
+    if filenames is not None:
+        query = query.filter(models.Emote.filename.in_(filenames))
+    return {filename for filename, in query}
+
+
+def reap(batch_size=500):
+    """Removes one batch of tombstoned blobs, returns how many tombstones were handled."""
+    filenames = [f.decode('utf-8') for f in get_redis().spop(TOMBSTONE_KEY, batch_size) or []]
+    if not filenames:
+        return 0
+
+    # other guilds may still use the blob, or the image was uploaded again
+    alive = referenced_filenames(filenames)
+    models.db.session.remove()
+    for filename in filenames:
+        if filename not in alive and storage.remove_blob(filename):
+            derivatives.forget([filename])
+            for size in derivatives.SIZES:
+                for ext in derivatives.FORMATS:
+                    storage.remove_blob(derivatives.derivative_name(filename, size, ext), grace=0)
+    return len(filenames)
+
+
+def sweep(grace=3600):
+    """Removes blobs that no emote references.
+
+    Blobs touched in the last ``grace`` seconds are left alone so uploads in
+    flight are never removed. Returns the number of removed blobs.
+    """
+    # variants live as long as the blob they were rendered from
+    alive = {filename.split('.', 1)[0] for filename in referenced_filenames()}
+    models.db.session.remove()
+    orphans = [name for name in storage.iter_blobs() if name.split('.', 1)[0] not in alive]
+    removed = [name for name in orphans if storage.remove_blob(name, grace=grace)]
+    derivatives.forget(removed)
+    return len(removed)
+
+
+def run(batch_size=500, sweep_interval=3600, idle=5):
+    """Reaps tombstones forever, sweeping every ``sweep_interval`` seconds."""
+    next_sweep = time.time()
+    while True:
+        if time.time() >= next_sweep:
+            removed = sweep()
+            if removed:
+                current_app.logger.info('Swept %s orphaned emote files', removed)
+            next_sweep = time.time() + sweep_interval
+
+        if reap(batch_size) < batch_size:
+            time.sleep(idle)
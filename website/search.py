@@ -0,0 +1,102 @@
+"""
+Emote name search.
+
+On PostgreSQL names are matched with ``ILIKE`` backed by a ``pg_trgm`` GIN
+index, so substring searches stay fast as the library grows. Other databases
+(SQLite in development and tests) fall back to an in-memory prefix trie that
+is rebuilt whenever the emote set changes.
+"""
+import threading
+
+from flask import current_app
+
+from .cache import fragment_generation
+from .models import Emote, db
+
+
+class PrefixTrie:
+    """Maps lowercased names to emote IDs and looks them up by prefix."""
+
+    def __init__(self):
+        self.root = {}
+
+    def insert(self, name, emote_id):
+        node = self.root
+        for char in name.lower():
+            node = node.setdefault(char, {})
+        node[None] = (name, emote_id)
+
+    def search(self, prefix, limit):
+        node = self.root
+        for char in prefix.lower():
+            node = node.get(char)
+            if node is None:
+                return []
+
+        # depth first, which yields names in alphabetical order
+        found, stack = [], [node]
+        while stack and len(found) < limit:
+            node = stack.pop()
+            if None in node:
+                found.append(node[None])
+            stack.extend(node[char] for char in sorted((c for c in node if c is not None), reverse=True))
+        return found
+
+
+_trie_lock = threading.Lock()
+
+
+def get_trie():
+    # emote changes bump the library generation, see models.handle_fragments
+    generation = fragment_generation('library')
+    with _trie_lock:
+        cached = getattr(current_app, 'name_trie', None)
+        if cached is None or cached[0] != generation:
+            trie = PrefixTrie()
+            # only names anyone may see, completions must not leak private emotes
+            for emote_id, name in Emote.all_shared_emotes().with_entities(Emote.id, Emote.name):
+                trie.insert(name, emote_id)
+            cached = current_app.name_trie = (generation, trie)
+        return cached[1]
+
+
+def _escape_like(query):
+    return query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _use_trigrams():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def search_library(query, limit=50):
+    """Returns shared emotes whose name contains ``query``, best matches first.
+
+    The trie fallback only matches names starting with ``query``.
+    """
+    emotes = Emote.all_shared_emotes()
+    if _use_trigrams():
+        pattern = '%' + _escape_like(query) + '%'
+        return emotes.filter(Emote.name.ilike(pattern, escape='\\')) \
+                     .order_by(db.func.similarity(Emote.name, query).desc(), Emote.id) \
+                     .limit(limit).all()
+
+    ids = [emote_id for _, emote_id in get_trie().search(query, limit)]
+    if not ids:
+        return []
+    return emotes.filter(Emote.id.in_(ids)).order_by(Emote.name).limit(limit).all()
+
+
+def complete_names(prefix, limit=10):
+    """Returns the names of shared emotes starting with ``prefix``."""
+    if _use_trigrams():
+        pattern = _escape_like(prefix) + '%'
+        rows = Emote.all_shared_emotes().with_entities(Emote.name) \
+                                        .filter(Emote.name.ilike(pattern, escape='\\')) \
+                                        .order_by(db.func.length(Emote.name), Emote.name).limit(limit)
+        return [name for name, in rows]
+
+    return [name for name, _ in get_trie().search(prefix, limit)]
+
+
+def name_taken(name):
+    return db.session.query(db.exists().where(Emote.name == name)).scalar()
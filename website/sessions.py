@@ -0,0 +1,131 @@
+"""
+Server-side sessions stored in Redis.
+
+Enabled with ``SERVER_SIDE_SESSION = True``. The cookie only carries an opaque
+session ID while the contents, most notably the OAuth2 token, live in a Redis
+hash under ``session:<sid>``. Only the fields a request changed are written
+back, so a refreshed token is updated in place and the cookie is only sent
+when a session is created or rotated.
+
+The session ID is stable for the lifetime of the login, which makes it a
+cheap key for the Discord data cached for the session, see
+:func:`website.cache.identity`.
+"""
+import binascii
+import os
+
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
+from werkzeug.datastructures import CallbackDict
+from werkzeug.exceptions import HTTPException
+
+from .cache import get_redis
+
+SESSION_KEY = 'session:'
+
+
+def _new_sid():
+    return binascii.hexlify(os.urandom(24)).decode('ascii')
+
+
+def _valid_sid(sid):
+    return sid is not None and len(sid) == 48 and all(c in '0123456789abcdef' for c in sid)
+
+
+class RedisSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, stored=None):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = sid is None
+        # serialized fields as they are in redis, values may be mutated in place
+        self.stored = stored or {}
+        self.modified = False
+
+    def regenerate(self):
+        """Moves the session to a new ID, e.g. on login to prevent session fixation."""
+        self.modified = True
+        self.previous_sid, self.sid, self.new = self.sid, _new_sid(), True
+
+
+def regenerate(session):
+    # cookie sessions have no ID to rotate
+    if isinstance(session, RedisSession):
+        session.regenerate()
+
+
+class RedisSessionInterface(SessionInterface):
+    serializer = session_json_serializer
+
+    # files never look at the session, don't make them wait on redis
+    sessionless_endpoints = {'static', 'main.static_emote'}
+
+    def _endpoint(self, app, request):
+        # the session is opened before the request is matched, do it ourselves
+        try:
+            endpoint, _ = app.create_url_adapter(request).match()
+        except HTTPException:
+            return None
+        return endpoint
+
+    def open_session(self, app, request):
+        if self._endpoint(app, request) in self.sessionless_endpoints:
+            return RedisSession()
+
+        sid = request.cookies.get(app.session_cookie_name)
+        if not _valid_sid(sid):
+            return RedisSession()
+
+        stored = get_redis().hgetall(SESSION_KEY + sid)
+        if not stored:
+            # expired or made up, never adopt an ID we did not hand out
+            return RedisSession()
+
+        stored = {key.decode('utf-8'): value.decode('utf-8') for key, value in stored.items()}
+        data = {key: self.serializer.loads(value) for key, value in stored.items()}
+        return RedisSession(data, sid=sid, stored=stored)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        r = get_redis()
+
+        previous = getattr(session, 'previous_sid', None)
+        if previous is not None:
+            r.delete(SESSION_KEY + previous)
+
+        if not session:
+            if session.sid is not None and session.modified:
+                r.delete(SESSION_KEY + session.sid)
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+
+        if not session.modified:
+            return
+
+        if session.new:
+            if session.sid is None:
+                session.sid = _new_sid()
+            # new and rotated sessions are written out whole
+            session.stored = {}
+
+        serialized = {key: self.serializer.dumps(value) for key, value in session.items()}
+        changed = {key: value for key, value in serialized.items() if session.stored.get(key) != value}
+        removed = [key for key in session.stored if key not in session]
+
+        key = SESSION_KEY + session.sid
+        with r.pipeline() as pipe:
+            if changed:
+                pipe.hmset(key, changed)
+            if removed:
+                pipe.hdel(key, *removed)
+            pipe.expire(key, int(app.permanent_session_lifetime.total_seconds()))
+            pipe.execute()
+
+        if session.new:
+            response.set_cookie(app.session_cookie_name, session.sid,
+                                expires=self.get_expiration_time(app, session),
+                                httponly=self.get_cookie_httponly(app),
+                                domain=domain, path=path,
+                                secure=self.get_cookie_secure(app))
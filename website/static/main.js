@@ -1,3 +1,50 @@
 function deleteNotification(notification) {
     notification.parentNode.removeChild(notification);
 }
+
+// Checks emote names as they are typed so collisions show up before uploading.
+(function() {
+    var form = document.querySelector('form[data-names-url]');
+    if (!form) {
+        return;
+    }
+
+    var input = form.querySelector('input[name="name"]');
+    var taken = document.getElementById('name-taken');
+    var list = document.createElement('datalist');
+    list.id = 'emote-names';
+    form.appendChild(list);
+    input.setAttribute('list', list.id);
+    input.setAttribute('autocomplete', 'off');
+
+    var timer = null;
+    input.addEventListener('input', function() {
+        clearTimeout(timer);
+        timer = setTimeout(function() {
+            var name = input.value.trim();
+            if (name.length < 3) {
+                taken.style.display = 'none';
+                return;
+            }
+
+            var request = new XMLHttpRequest();
+            request.open('GET', form.getAttribute('data-names-url') + '?q=' + encodeURIComponent(name));
+            request.onload = function() {
+                if (request.status !== 200 || input.value.trim() !== name) {
+                    return;
+                }
+
+                var data = JSON.parse(request.responseText);
+                taken.style.display = data.available ? 'none' : '';
+                input.classList.toggle('is-danger', !data.available);
+                list.innerHTML = '';
+                data.matches.forEach(function(match) {
+                    var option = document.createElement('option');
+                    option.value = match;
+                    list.appendChild(option);
+                });
+            };
+            request.send();
+        }, 200);
+    });
+})();
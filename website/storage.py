@@ -0,0 +1,292 @@
+"""
+Content-addressed emote storage.
+
+Emote files are named after the hash of their contents, so one file can back
+any number of :class:`~website.models.Emote` rows across guilds. A blob is
+referenced by every emote row with its filename and may be removed once none
+are left.
+
+Blobs are kept by a backend picked with ``EMOTE_STORAGE``:
+
+``local`` (the default)
+    ``UPLOAD_FOLDER/blobs/<aa>/<bb>/<filename>``, served by the app or the
+    front proxy. Every web worker needs to see the same disk.
+``s3``
+    An S3 compatible bucket (AWS, MinIO, ...) configured with ``S3_BUCKET``,
+    ``S3_ENDPOINT_URL`` and ``S3_PREFIX``. Requires ``boto3``. Emote URLs
+    redirect to ``S3_PUBLIC_URL`` if set, or to presigned URLs otherwise.
+"""
+import os
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from flask import current_app
+
+BLOB_DIR = 'blobs'
+
+# blobs are named after their contents and never change
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def blob_path(filename):
+    """Returns the path of a blob relative to the storage root."""
+    return os.path.join(BLOB_DIR, filename[:2], filename[2:4], filename)
+
+
+class LocalBackend:
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, filename):
+        return os.path.join(self.root, blob_path(filename))
+
+    def exists(self, filename):
+        return os.path.exists(self.path(filename))
+
+    def touch(self, filename):
+        try:
+            os.utime(self.path(filename), None)
+        except OSError:
+            return False
+        return True
+
+    def put(self, filename, data):
+        path = self.path(filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+        try:
+            with open(tmp, 'wb') as fp:
+                fp.write(data)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def read(self, filename):
+        with open(self.path(filename), 'rb') as fp:
+            return fp.read()
+
+    def modified(self, filename):
+        return os.path.getmtime(self.path(filename))
+
+    def delete(self, filename):
+        os.remove(self.path(filename))
+
+    def list(self):
+        for directory, _, files in os.walk(os.path.join(self.root, BLOB_DIR)):
+            for name in files:
+                if not name.endswith('.tmp'):
+                    yield name
+
+    def url(self, filename):
+        # served by static_emote
+        return None, None
+
+
+class S3Backend:
+    def __init__(self, bucket, prefix='', endpoint_url=None, public_url=None, presign_expiry=3600):
+        import boto3
+        from botocore.exceptions import ClientError
+        self.client = boto3.client('s3', endpoint_url=endpoint_url)
+        self.ClientError = ClientError
+        self.bucket = bucket
+        self.prefix = prefix
+        self.public_url = public_url
+        self.presign_expiry = presign_expiry
+
+    def key(self, filename):
+        return self.prefix + blob_path(filename)
+
+    def _head(self, filename):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.key(filename))
+        except self.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise OSError(str(e))
+
+    def exists(self, filename):
+        return self._head(filename) is not None
+
+    def touch(self, filename):
+        # copying an object onto itself is the only way to bump LastModified
+        key = self.key(filename)
+        try:
+            # replacing the metadata drops it, so everything put() sets goes again
+            self.client.copy_object(Bucket=self.bucket, Key=key, CopySource={'Bucket': self.bucket, 'Key': key},
+                                    MetadataDirective='REPLACE', ContentType=_content_type(filename),
+                                    CacheControl=IMMUTABLE_CACHE_CONTROL)
+        except self.ClientError:
+            return False
+        return True
+
+    def put(self, filename, data):
+        # emotes are tiny, a single PUT is all we ever need
+        self.client.put_object(Bucket=self.bucket, Key=self.key(filename), Body=data,
+                               ContentType=_content_type(filename),
+                               CacheControl=IMMUTABLE_CACHE_CONTROL)
+
+    def read(self, filename):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self.key(filename))['Body'].read()
+        except self.ClientError as e:
+            raise OSError(str(e))
+
+    def modified(self, filename):
+        head = self._head(filename)
+        if head is None:
+            raise OSError('No such blob: %s' % filename)
+        return head['LastModified'].timestamp()
+
+    def delete(self, filename):
+        try:
+            self.client.delete_object(Bucket=self.bucket, Key=self.key(filename))
+        except self.ClientError as e:
+            raise OSError(str(e))
+
+    def list(self):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + BLOB_DIR + '/'):
+            for item in page.get('Contents', []):
+                yield item['Key'].rsplit('/', 1)[-1]
+
+    def url(self, filename):
+        if self.public_url:
+            return self.public_url.rstrip('/') + '/' + self.key(filename), None
+        url = self.client.generate_presigned_url('get_object', Params={'Bucket': self.bucket,
+                                                                       'Key': self.key(filename)},
+                                                 ExpiresIn=self.presign_expiry)
+        return url, self.presign_expiry
+
+
+def _content_type(filename):
+    ext = filename.rsplit('.', 1)[-1]
+    return {'jpg': 'image/jpeg'}.get(ext, 'image/' + ext)
+
+
+def make_backend(name, config):
+    if name == 'local':
+        return LocalBackend(config['UPLOAD_FOLDER'])
+    if name == 's3':
+        return S3Backend(config['S3_BUCKET'],
+                         prefix=config.get('S3_PREFIX', ''),
+                         endpoint_url=config.get('S3_ENDPOINT_URL'),
+                         public_url=config.get('S3_PUBLIC_URL'),
+                         presign_expiry=config.get('S3_PRESIGN_EXPIRY', 3600))
+    raise RuntimeError('Unknown storage backend: %s' % name)
+
+
+def get_backend():
+    if not hasattr(current_app, 'storage_backend'):
+        config = current_app.config
+        current_app.storage_backend = make_backend(config.get('EMOTE_STORAGE', 'local'), config)
+
+    return current_app.storage_backend
+
+
+def exists(filename):
+    return get_backend().exists(filename)
+
+
+def save_blob(filename, data):
+    """Stores a blob unless it already exists.
+
+    Returns ``True`` if the blob was written.
+    """
+    backend = get_backend()
+    # refresh the mtime so the reaper leaves a blob that just got a new reference
+    if backend.exists(filename) and backend.touch(filename):
+        return False
+
+    backend.put(filename, data)
+    return True
+
+
+def read_blob(filename):
+    """Returns the contents of a blob, raises :exc:`OSError` if it is missing."""
+    return get_backend().read(filename)
+
+
+def blob_url(filename):
+    """Returns a URL the blob can be fetched from directly, if the backend has one.
+
+    Returns a ``(url, lifetime)`` tuple, ``lifetime`` is the number of seconds
+    the URL stays valid for or ``None`` if it does not expire.
+    """
+    return get_backend().url(filename)
+
+
+def remove_blob(filename, grace=60):
+    """Removes a blob unless it was touched in the last ``grace`` seconds."""
+    backend = get_backend()
+    try:
+        if backend.modified(filename) > time.time() - grace:
+            return False
+        backend.delete(filename)
+    except OSError:
+        return False
+    return True
+
+
+def iter_blobs():
+    """Yields the filename of every stored blob."""
+    return get_backend().list()
+
+
+def copy_blobs(source, dest, workers=8):
+    """Copies every blob missing from the ``dest`` backend over from ``source``.
+
+    At most ``workers`` blobs are in flight at once. Returns a ``(copied,
+    skipped)`` tuple of blob counts.
+    """
+    def copy(filename):
+        if dest.exists(filename):
+            return False
+        dest.put(filename, source.read(filename))
+        return True
+
+    results = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # map() would queue every blob up front, keep the backlog bounded instead
+        pending = set()
+        for filename in source.list():
+            if len(pending) >= workers * 4:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                results.extend(f.result() for f in done)
+            pending.add(executor.submit(copy, filename))
+
+        done, _ = wait(pending)
+        results.extend(f.result() for f in done)
+
+    copied = sum(results)
+    return copied, len(results) - copied
+
+
+def import_legacy():
+    """Moves files from the old ``UPLOAD_FOLDER/<guild_id>/`` layout into the blob store.
+
+    Returns a ``(moved, deduplicated)`` tuple of file counts.
+    """
+    root = current_app.config['UPLOAD_FOLDER']
+    moved = deduplicated = 0
+    for guild_dir in os.listdir(root):
+        directory = os.path.join(root, guild_dir)
+        if not guild_dir.isdigit() or not os.path.isdir(directory):
+            continue
+
+        for name in os.listdir(directory):
+            source = os.path.join(directory, name)
+            with open(source, 'rb') as fp:
+                if save_blob(name, fp.read()):
+                    moved += 1
+                else:
+                    deduplicated += 1
+            os.remove(source)
+
+        try:
+            os.rmdir(directory)
+        except OSError:
+            pass
+
+    return moved, deduplicated
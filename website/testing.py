@@ -0,0 +1,41 @@
+"""
+Helpers for tests.
+"""
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from .models import db
+
+
+@contextmanager
+def count_queries(engine=None):
+    """Records the SQL statements executed inside the block.
+
+    Yields a list that is filled with the statements as they run::
+
+        with count_queries() as queries:
+            client.get('/guilds/1234')
+        assert len(queries) == 2
+    """
+    engine = engine or db.engine
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+@contextmanager
+def assert_num_queries(expected, engine=None):
+    """Fails if the block does not execute exactly ``expected`` SQL statements."""
+    with count_queries(engine) as statements:
+        yield statements
+
+    if len(statements) != expected:
+        raise AssertionError('Expected %s queries, got %s:\n%s' % (expected, len(statements), '\n'.join(statements)))
@@ -0,0 +1,122 @@
+"""
+Background refresh of OAuth2 tokens.
+
+Tokens kept in server-side sessions are scheduled in a Redis sorted set by the
+time they should be refreshed, ``TOKEN_REFRESH_MARGIN`` seconds before their
+``expires_at``. The refresher worker (``flask tokens``) renews them ahead of
+time so requests rarely pay for a refresh round trip to Discord.
+
+Cached Discord data is keyed by the session ID (see
+:func:`website.cache.identity`) and carries over to the new token as is. A
+failed refresh never logs anyone out: transient errors are retried later and
+a rejected refresh token just leaves the session to the usual in-request
+handling once the access token expires.
+"""
+import time
+
+import redis
+from flask import current_app
+from oauthlib.oauth2 import OAuth2Error
+from requests import RequestException
+
+from .cache import get_redis
+from .sessions import SESSION_KEY, RedisSessionInterface
+from . import discord
+
+REFRESH_KEY = 'tokens:refresh'
+
+TOKEN_FIELD = 'oauth2_token'
+
+
+def schedule(sid, token):
+    """Schedules the refresh of a session's token, ``sid`` may be ``None`` with cookie sessions."""
+    if sid is None or token is None or 'expires_at' not in token:
+        return
+
+    margin = current_app.config.get('TOKEN_REFRESH_MARGIN', 24 * 3600)
+    get_redis().zadd(REFRESH_KEY, {sid: token['expires_at'] - margin})
+
+
+def unschedule(sid):
+    if sid is not None:
+        get_redis().zrem(REFRESH_KEY, sid)
+
+
+def _store(r, sid, old, token):
+    """Replaces a session's token unless it changed since it was read."""
+    key = SESSION_KEY + sid
+    serializer = RedisSessionInterface.serializer
+    with r.pipeline() as pipe:
+        pipe.watch(key)
+        if pipe.hget(key, TOKEN_FIELD) != old:
+            # logged out or refreshed by a request in the meantime
+            pipe.reset()
+            return False
+        pipe.multi()
+        pipe.hset(key, TOKEN_FIELD, serializer.dumps(token))
+        try:
+            pipe.execute()
+        except redis.WatchError:
+            return False
+    return True
+
+
+def refresh(sid):
+    """Refreshes the token of a session.
+
+    Returns the new token, or ``None`` if the session is gone or its token
+    was changed by someone else. Raises the underlying error on failure.
+    """
+    r = get_redis()
+    raw = r.hget(SESSION_KEY + sid, TOKEN_FIELD)
+    if raw is None:
+        return None
+
+    token = RedisSessionInterface.serializer.loads(raw.decode('utf-8'))
+    config = current_app.config
+    with discord.make_session(token=token) as oauth:
+        new_token = oauth.refresh_token(discord.DISCORD_TOKEN_URL,
+                                        refresh_token=token['refresh_token'],
+                                        client_id=config['OAUTH2_CLIENT_ID'],
+                                        client_secret=config['OAUTH2_SECRET_KEY'])
+
+    if not _store(r, sid, raw, new_token):
+        return None
+    return new_token
+
+
+def refresh_due(batch_size=50, retry_delay=300):
+    """Refreshes the tokens that are due, returns how many sessions were handled."""
+    r = get_redis()
+    logger = current_app.logger
+    due = r.zrangebyscore(REFRESH_KEY, '-inf', time.time(), start=0, num=batch_size)
+
+    handled = 0
+    for sid in due:
+        # claiming the entry keeps other refreshers off this session
+        if not r.zrem(REFRESH_KEY, sid):
+            continue
+
+        sid = sid.decode('utf-8')
+        handled += 1
+        try:
+            token = refresh(sid)
+        except OAuth2Error as e:
+            # revoked or otherwise rejected, the access token is still good until it expires
+            logger.info('Not refreshing the token of session %s: %s', sid[:8], e)
+            continue
+        except (RequestException, ValueError):
+            logger.warning('Failed to refresh the token of session %s, retrying later', sid[:8], exc_info=True)
+            r.zadd(REFRESH_KEY, {sid: time.time() + retry_delay})
+            continue
+
+        schedule(sid, token)
+
+    return handled
+
+
+def run(batch_size=50, interval=30):
+    """Refreshes due tokens forever."""
+    while True:
+        if refresh_due(batch_size) < batch_size:
+            time.sleep(interval)
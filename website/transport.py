@@ -0,0 +1,64 @@
+"""
+Shared HTTP transport for outbound Discord traffic.
+
+Every worker keeps one pooled adapter so the OAuth2 sessions and the bot
+API calls reuse keep-alive connections instead of paying for a new TCP and
+TLS handshake on each request.
+"""
+import requests
+from flask import current_app
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class PooledAdapter(HTTPAdapter):
+    """An :class:`HTTPAdapter` with a default timeout that outlives its sessions.
+
+    Sessions are short lived (``with make_session() as discord``) and closing
+    a session closes its adapters, so :meth:`close` is a no-op here and the
+    pooled connections live as long as the process.
+    """
+
+    def __init__(self, timeout=None, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
+    def close(self):
+        pass
+
+
+def get_adapter():
+    if not hasattr(current_app, 'http_adapter'):
+        config = current_app.config
+        retries = Retry(total=config.get('DISCORD_RETRIES', 3),
+                        backoff_factor=config.get('DISCORD_BACKOFF', 0.3),
+                        status_forcelist=(500, 502, 503, 504),
+                        raise_on_status=False)
+        pool_size = config.get('DISCORD_POOL_SIZE', 10)
+        current_app.http_adapter = PooledAdapter(timeout=config.get('DISCORD_TIMEOUT', (3.05, 10)),
+                                                 pool_connections=pool_size,
+                                                 pool_maxsize=pool_size,
+                                                 max_retries=retries)
+
+    return current_app.http_adapter
+
+
+def mount(session):
+    """Makes a :class:`requests.Session` use the shared connection pool."""
+    adapter = get_adapter()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session():
+    """Returns the worker's shared session for bot API calls."""
+    if not hasattr(current_app, 'http_session'):
+        current_app.http_session = mount(requests.Session())
+
+    return current_app.http_session
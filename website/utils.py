@@ -1,6 +1,46 @@
 from functools import wraps
-from flask import g, request, redirect, url_for, abort
+from flask import g, request, redirect, url_for, abort, current_app
+from flask.ctx import _AppCtxGlobals
 from .models import Guild
+from . import discord
+
+class lazy_global:
+    """Descriptor that computes an attribute of :data:`flask.g` on first access.
+
+    The result is stored in the instance dictionary so the function runs at most
+    once per request and can still be overwritten by plain assignment.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = instance.__dict__[self.__name__] = self.func(instance)
+        return value
+
+class RequestGlobals(_AppCtxGlobals):
+    """The :data:`flask.g` class used by the application.
+
+    The Discord identity of the current request is resolved lazily, so
+    endpoints that never look at ``g.user`` or ``g.guilds`` (static files,
+    emote images) never build an OAuth2 session or hit Redis.
+    """
+
+    @lazy_global
+    def user(self):
+        return discord.User.current()
+
+    @lazy_global
+    def guilds(self):
+        return discord.BriefGuild.managed()
+
+    @property
+    def is_admin(self):
+        return self.user is not None and self.user.id in current_app.config['ADMIN_USER_IDS']
 
 def login_required(f):
     """Decorator that makes the view require logging in.
@@ -2,19 +2,20 @@ from sqlalchemy.exc import IntegrityError
 from werkzeug.utils import secure_filename
 from flask import session, request, g
 from flask import render_template, flash
-from flask import redirect, url_for, send_from_directory, abort
-from flask import Blueprint, current_app
+from flask import redirect, url_for, send_from_directory, abort, jsonify
+from flask import Blueprint, Response, current_app, stream_with_context
 from flask_wtf.csrf import CsrfProtect
 
-from PIL import Image
 import sys
-import errno
 import random
-import os, hashlib
+import mimetypes
 
-from .discord import make_session, BriefGuild, DISCORD_AUTH_BASE_URL, DISCORD_TOKEN_URL
-from .models import Emote, Guild, db, guild_emotes, add_shared_emote
+from .cache import cached_fragment, invalidate_token
+from .discord import make_session, session_id, BriefGuild, DISCORD_AUTH_BASE_URL, DISCORD_TOKEN_URL
+from .models import Emote, Guild, KeysetPage, db, guild_emotes, guild_emotes_query, add_shared_emote, library_count, \
+    lock_emote_quota
 from .forms import EmoteUploadForm
+from . import bulk, derivatives, images, search, sessions, storage, tokens
 from .utils import login_required, guild_admin_required, public_guild_required, get_guild_or_404
 
 main = Blueprint('main', __name__)
@@ -37,6 +38,8 @@ def login():
 
 @main.route('/logout')
 def logout():
+    invalidate_token(session.get('oauth2_token'), sid=session_id())
+    tokens.unschedule(session_id())
     session.clear()
     return redirect(url_for('.index'))
 
@@ -51,8 +54,11 @@ def callback():
                                     client_secret=current_app.config['OAUTH2_SECRET_KEY'],
                                     authorization_response=request.url)
 
+        # a fresh session ID for the login, any planted one is useless
+        sessions.regenerate(session)
         session['oauth2_token'] = token
         session.permanent = True
+        tokens.schedule(session_id(), token)
         return redirect(url_for('.guilds'))
 
 @main.route('/guilds')
@@ -63,9 +69,13 @@ def guilds():
 @main.route('/guilds/<int:guild_id>')
 @public_guild_required
 def guild(guild_id):
-    emotes = guild_emotes(guild_id)
+    def render():
+        return render_template('_guild_emotes.html', emotes=guild_emotes(guild_id))
+
+    emotes_table = cached_fragment(['guild:%s' % guild_id], 'emotes', render)
     can_manage = isinstance(g.guild, BriefGuild)
-    return render_template('guild.html', emotes=emotes, can_manage=can_manage, guild=g.guild, title=g.guild.name)
+    return render_template('guild.html', emotes_table=emotes_table, can_manage=can_manage, guild=g.guild,
+                           title=g.guild.name)
 
 @main.route('/guilds/<int:guild_id>/emotes/<int:emote_id>', methods=['GET', 'POST'])
 def emote(guild_id, emote_id):
@@ -105,10 +115,14 @@ def emote(guild_id, emote_id):
                     flash('Emote added to %s' % managed.name, 'is-success')
                     return redirect(url_for('.guild', guild_id=requested_guild_id))
 
+    def render_shared_guilds():
+        shared_guilds = emote.public_shared_guilds()
+        return render_template('_shared_guilds.html', emote=emote, shared_guilds=shared_guilds)
+
     context = {
         'guild': guild,
         'can_manage': can_manage,
-        'shared_guilds': [s for s in emote.shared_guilds if s.public],
+        'shared_guilds': cached_fragment(['emote:%s' % emote.id, 'emotes'], 'shared_guilds', render_shared_guilds),
         'emote': emote,
         'title': emote.name
     }
@@ -118,38 +132,26 @@ def emote(guild_id, emote_id):
 @login_required
 @guild_admin_required
 def add_emote(guild_id):
-    emotes = guild_emotes(guild_id)
-
     form = EmoteUploadForm()
     if form.validate_on_submit():
-        if len(emotes) >= 10:
-            flash('You have already reached the maximum number of emotes for this server', 'is-danger')
-            return redirect(request.url)
-
         try:
-            image = Image.open(form.emote.data)
-        except Exception as e:
-            flash('Invalid image', 'is-danger')
+            image = images.validate(form.emote.data.stream, current_app.config['EMOTE_MAX_BYTES'])
+        except RuntimeError as e:
+            flash(str(e), 'is-danger')
             return redirect(request.url)
 
-        ext = image.format
-        if ext not in ('JPEG', 'PNG'):
-            flash('Unsupported file extension (.%s).' % ext, 'is-danger')
-            return redirect(request.url)
+        hashed_filename = image.filename
 
-        if image.width > 128 or image.height > 128:
-            flash('Image too big (got %sx%s and expected 128x128 or lower)' % (image.width, image.height), 'is-danger')
+        # serializes uploads to this guild until the commit below
+        try:
+            lock_emote_quota(guild_id)
+        except RuntimeError:
+            db.session.rollback()
+            flash('You have already reached the maximum number of emotes for this server', 'is-danger')
             return redirect(request.url)
 
-        if image.format == "PNG":
-            ext = "png"
-        else:
-            ext = "jpg"
-
-        sha224 = hashlib.sha224(image.tobytes())
-        hashed_filename = '{}.{}'.format(sha224.hexdigest(), ext)
-
-        if hashed_filename in [e.filename for e in emotes]:
+        if db.session.query(guild_emotes_query(guild_id).filter(Emote.filename == hashed_filename).exists()).scalar():
+            db.session.rollback()
             flash('That image is already used for an emote. Choose another image.', 'is-danger')
             return redirect(request.url)
 
@@ -164,28 +166,127 @@ def add_emote(guild_id):
         try:
             db.session.commit()
         except IntegrityError:
+            db.session.rollback()
             return redirect(request.url)
 
-        try:
-            os.makedirs(os.path.join(current_app.config['UPLOAD_FOLDER'], str(guild_id)))
-        except OSError as exception:
-            if exception.errno != errno.EEXIST:
-                raise
-
-        image.save(os.path.join(current_app.config['UPLOAD_FOLDER'], emote.path()))
+        # identical images uploaded by other guilds share a single file
+        if storage.save_blob(hashed_filename, image.data):
+            derivatives.schedule(hashed_filename, image.data)
         flash('Successfully uploaded emote.', 'is-success')
         return redirect(url_for('.guild', guild_id=guild_id))
 
     return render_template('add_emote.html', form=form, guild=g.managed_guild)
 
-@main.route('/emotes/<int:guild_id>/<path:filename>')
+@main.route('/guilds/<int:guild_id>/emotes/import', methods=['POST'])
+@login_required
+@guild_admin_required
+def import_emotes(guild_id):
+    archive = request.files.get('archive')
+    if not archive:
+        flash('Choose a ZIP archive to import.', 'is-danger')
+        return redirect(url_for('.guild', guild_id=guild_id))
+
+    try:
+        imported, errors = bulk.import_emotes(guild_id, archive.stream, current_app.config['EMOTE_MAX_BYTES'],
+                                              derivatives.get_pool(), shared='shared' in request.form)
+    except RuntimeError as e:
+        flash(str(e), 'is-danger')
+        return redirect(url_for('.guild', guild_id=guild_id))
+
+    if imported:
+        flash('Imported %s emotes.' % len(imported), 'is-success')
+    if errors:
+        # one capped message, flashes live in the session cookie
+        skipped = ['%s (%s)' % (filename, error) for filename, error in sorted(errors.items())[:3]]
+        if len(errors) > len(skipped):
+            skipped.append('%s more' % (len(errors) - len(skipped)))
+        flash('Skipped %s files: %s' % (len(errors), ', '.join(skipped)), 'is-danger')
+    return redirect(url_for('.guild', guild_id=guild_id))
+
+@main.route('/guilds/<int:guild_id>/emotes/export')
+@login_required
+@guild_admin_required
+def export_emotes(guild_id):
+    response = Response(stream_with_context(bulk.export_emotes(guild_id)), mimetype='application/zip')
+    response.headers['Content-Disposition'] = 'attachment; filename=emotes-%s.zip' % guild_id
+    return response
+
+# emote files are named after their content hash so they never change
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+@main.route('/emotes/<int:guild_id>/<filename>')
 def static_emote(guild_id, filename):
-    return send_from_directory(os.path.join(current_app.config['UPLOAD_FOLDER'], str(guild_id)), filename)
+    # the guild ID only keeps URLs readable, files are stored by content hash
+    if request.if_none_match.contains(filename):
+        # the filename is the ETag, no need to look at the disk
+        response = current_app.response_class(status=304)
+        response.set_etag(filename)
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        return response
+
+    immutable = True
+    if derivatives.is_derivative(filename) and not derivatives.is_rendered(filename):
+        # the variant has not been rendered yet, serve the original for now
+        # without letting anyone cache it under this name
+        immutable = False
+        filename = derivatives.source_of(filename)
+        if filename is None:
+            abort(404)
+
+    url, lifetime = storage.blob_url(filename)
+    accel_prefix = current_app.config.get('EMOTE_ACCEL_REDIRECT')
+    if url is not None:
+        # the storage backend serves the file itself
+        response = redirect(url)
+        if immutable and lifetime is not None:
+            # presigned URLs expire, the redirect must not outlive them
+            response.headers['Cache-Control'] = 'public, max-age=%s' % (lifetime // 2)
+            return response
+    elif accel_prefix:
+        # let the front proxy send the file, USE_X_SENDFILE does the same for Apache/lighttpd
+        response = current_app.response_class(mimetype=mimetypes.guess_type(filename)[0])
+        response.headers['X-Accel-Redirect'] = accel_prefix.rstrip('/') + '/' + storage.blob_path(filename)
+    else:
+        response = send_from_directory(current_app.config['UPLOAD_FOLDER'], storage.blob_path(filename))
+
+    if immutable:
+        response.set_etag(request.view_args['filename'])
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 @main.route('/library')
+def library():
+    after = request.args.get('after', type=int)
+    before = request.args.get('before', type=int)
+
+    def render():
+        emotes = Emote.library_page(int(current_app.config['EMOTES_PER_PAGE']), after=after, before=before)
+        if not emotes.items and (after is not None or before is not None):
+            abort(404)
+        return render_template('_library_emotes.html', emotes=emotes)
+
+    emotes_grid = cached_fragment(['library'], '%s:%s' % (after, before), render)
+    return render_template('library.html', title='Shared Library', emotes_grid=emotes_grid, total=library_count())
+
+@main.route('/library/search')
+def library_search():
+    query = request.args.get('q', '').strip()
+    emotes = KeysetPage(search.search_library(query) if query else [], has_prev=False, has_next=False)
+    emotes_grid = render_template('_library_emotes.html', emotes=emotes)
+    return render_template('library.html', title='Search: %s' % query if query else 'Shared Library',
+                           emotes_grid=emotes_grid, total=library_count(), query=query)
+
+@main.route('/api/emotes/names')
+def emote_names():
+    """Autocompletion for emote names, used to catch name collisions before uploading."""
+    name = request.args.get('q', '').strip()
+    if not name:
+        return jsonify(available=False, matches=[])
+    return jsonify(available=not search.name_taken(name), matches=search.complete_names(name))
+
 @main.route('/library/<int:page>')
-def library(page=1):
-    emotes = Emote.all_shared_emotes().paginate(page, int(current_app.config['EMOTES_PER_PAGE']), False)
-    if not emotes.items and page != 1:
-        abort(404)
-    return render_template('library.html', title='Shared Library', emotes=emotes)
+def library_offset(page):
+    # the library used to be paginated by page number
+    return redirect(url_for('.library'), code=301)